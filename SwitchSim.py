@@ -4,406 +4,2718 @@
 This is a simulation of simple network switch's operations
 """
 
-from sys import exit
+from array import array
+from collections import Counter, OrderedDict, deque
+from heapq import heappop, heappush
+from concurrent.futures import ProcessPoolExecutor
+from itertools import compress, count, islice
+from operator import ne
+from os import chmod, cpu_count, remove, replace, stat as os_stat, umask
+from mmap import ACCESS_READ, mmap
+from os import path as os_path
+from stat import S_IMODE
+from string import hexdigits
+from tempfile import mkstemp
+from struct import Struct
+from sys import argv, byteorder, exit
+from random import Random
+from time import perf_counter, time
+import asyncio
+import csv
+import gc
+import json
+
+
+# Forwarding decisions returned by Switch.send_frame and Switch.send_frames: a frame is either sent out of a
+# single port (decision is the port number), flooded to the VLAN, sent to ports of a multicast group, or filtered
+# because its destination is in another VLAN
+FRAME_FLOODED = -1
+FRAME_FILTERED = -2
+FRAME_MULTICAST = -3
+
+
+# MAC addresses are handled as 48-bit integers; they're parsed from the 'xxxx.xxxx.xxxx' format once, when
+# a workstation is created or a trace is read, and formatted back only for display. Parsed addresses are cached,
+# so every address is parsed once and all frames share the same int object
+
+_parsed_macs = {}
+_MAX_PARSED_MACS = 1 << 20
+
+
+def parse_mac(text):
+    mac = _parsed_macs.get(text)
+    if mac is None:
+        parts = text.strip().split('.')
+        if len(parts) != 3 or not all(len(part) == 4 for part in parts):
+            raise ValueError("Invalid MAC address '{}', format is xxxx.xxxx.xxxx".format(text))
+        if not all(c in hexdigits for part in parts for c in part):
+            raise ValueError("Invalid MAC address '{}', MAC address must have hex digits only".format(text))
+        mac = int(''.join(parts), 16)
+        if len(_parsed_macs) >= _MAX_PARSED_MACS:
+            _parsed_macs.clear()
+        _parsed_macs[text] = mac
+    return mac
+
+
+def format_mac(mac):
+    digits = '{:012x}'.format(mac)
+    return '{}.{}.{}'.format(digits[:4], digits[4:8], digits[8:])
+
+
+# Frames to the broadcast address are flooded to the whole VLAN. Addresses with the group bit set (the lowest bit
+# of the first octet) are multicast groups: frames to a group are sent only to ports which joined it on the switch,
+# or flooded if no port did (see Switch.join_group)
+BROADCAST_MAC = 0xffffffffffff
+GROUP_BIT = 1 << 40
+
+
+def is_group_mac(mac):
+    return bool(mac & GROUP_BIT)
+
+
+# An entry of a switch's MAC table
+class MacEntry:
+
+    __slots__ = ('port', 'stamp', 'vlan')
+
+    # port the MAC address was learned at, step when the MAC address was last seen, VLAN number
+
+    def __init__(self, port, stamp, vlan):
+        self.port = port
+        self.stamp = stamp
+        self.vlan = vlan
+
+    def copy(self):
+        return MacEntry(self.port, self.stamp, self.vlan)
 
 
 # Class NetDevice is a general model of a networking device
 # Note that this model is not supposed to provide a simulation of all functions of real gears
 class NetDevice:
 
-    # Create a networking device with a num of ports provided
+    # Create a networking device with a num of ports provided. Ports are numbered from 0 and are sparse: a port
+    # gets a slot in flat per-port arrays only when it's used for the first time, so a device with millions of
+    # ports is created at once and takes memory only for the ports which are actually used
 
     def __init__(self, num_ports):
         self.num_ports = abs(num_ports)
-        self.ports = {}
-        for port in range(num_ports):
-            self.ports['port_{}'.format(str(port))] = {'sent_frames': {'sent': 0, 'buffer': []}, 'received': 0}
-            # Buffer stores frames' destination MAC addresses which are checked by target hosts
+        self._slots = {}                  # port -> index of the port's state in the per-port arrays
+        self._sent = array('Q')           # frames sent out of each port
+        self._received = array('Q')       # frames received at each port
+        # Buffer stores frames' destination MAC addresses which are checked by target hosts. Each port buffer
+        # maps a destination MAC to a number of frames queued for it and is stamped with the epoch it was
+        # filled in; a buffer filled in an earlier epoch is stale and is treated as empty
+        self._epoch = 0
+        self._buffer_epochs = array('q')
+        self._buffers = []
+        # Running totals, so that totals don't have to be summed up over all ports
+        self._total_sent = 0
+        self._total_received = 0
+        # Ports whose counters changed since they were last taken by a statistics stream (see StatsStream)
+        self._dirty_ports = set()
+        # Counts changes of the device's state other than frames passing through it, e.g. configuration changes;
+        # together with the epoch it tells whether the device changed since the last snapshot (see RuntimeEnv.save)
+        self._revision = 0
+
+    # Slot of a port in the per-port arrays; the port's state is created when it's used for the first time
+
+    def _slot(self, port_num):
+        slot = self._slots.get(port_num)
+        if slot is None:
+            slot = self._add_port(port_num)
+        return slot
+
+    def _add_port(self, port_num):
+        if not 0 <= port_num < self.num_ports:
+            raise IndexError("Port {} doesn't exist".format(port_num))
+        slot = self._slots[port_num] = len(self._sent)
+        self._sent.append(0)
+        self._received.append(0)
+        self._buffer_epochs.append(-1)
+        self._buffers.append(None)
+        return slot
 
     # Request a number of datagrams sent out of a specified port
 
     def get_sent_for_port(self, port_num):
-        return self.ports['port_{}'.format(str(port_num))]['sent_frames']['sent']
+        slot = self._slots.get(int(port_num))
+        return 0 if slot is None else self._sent[slot]
 
     # Request a number of datagrams received at a specified port
 
     def get_received_for_port(self, port_num):
-        return self.ports['port_{}'.format(str(port_num))]['received']
+        slot = self._slots.get(int(port_num))
+        return 0 if slot is None else self._received[slot]
 
     # Total number of datagrams sent by the net device
 
     @property
     def total_sent(self):
-        sent = 0
-        for port in self.ports:
-            sent += self.ports[port]['sent_frames']['sent']
-        return sent
+        return self._total_sent
 
     # Total number of datagrams received by the net device
 
     @property
     def total_received(self):
-        received = 0
-        for port in self.ports:
-            received += self.ports[port]['received']
-        return received
+        return self._total_received
+
+    # Frames currently queued in a buffer of a specified port: destination MAC -> number of frames
+
+    def get_buffered_for_port(self, port_num):
+        slot = self._slots.get(int(port_num))
+        if slot is None or self._buffer_epochs[slot] != self._epoch:
+            return {}
+        return dict(self._buffers[slot])
+
+    # Queue a frame in a port buffer
+
+    def _buffer_frame(self, port_num, dest_mac):
+        slot = self._slot(port_num)
+        if self._buffer_epochs[slot] != self._epoch:
+            self._buffer_epochs[slot] = self._epoch
+            self._buffers[slot] = {dest_mac: 1}
+        else:
+            buffer = self._buffers[slot]
+            buffer[dest_mac] = buffer.get(dest_mac, 0) + 1
+
+    # Take all frames queued for a destination MAC out of a port buffer; returns a number of frames taken
 
-    # Receiving datagram
+    def pull_frames(self, port_num, dest_mac):
+        slot = self._slots.get(port_num)
+        if slot is None or self._buffer_epochs[slot] != self._epoch:
+            return 0
+        self._revision += 1
+        return self._buffers[slot].pop(dest_mac, 0)
 
-    def receive(self, port_num):
-        self.ports['port_{}'.format(port_num)]['received'] += 1
+    # Ports whose counters changed since the last call; the set of changed ports starts over
+
+    def _take_changed_ports(self):
+        ports = self._dirty_ports
+        self._dirty_ports = set()
+        return ports
+
+    # Start a new epoch: frames left in port buffers become stale, so there is no need to clear buffers one by one
+
+    def _new_epoch(self):
+        self._epoch += 1
+
+    # Receiving datagram(s)
+
+    def receive(self, port_num, frames=1):
+        slot = self._slots.get(port_num)
+        if slot is None:
+            slot = self._add_port(port_num)
+        self._received[slot] += frames
+        self._total_received += frames
+        self._dirty_ports.add(port_num)
 
     # Sending datagram
 
     def send(self, port_num):
-        self.ports['port_{}'.format(port_num)]['sent_frames']['sent'] += 1
+        slot = self._slots.get(port_num)
+        if slot is None:
+            slot = self._add_port(port_num)
+        self._sent[slot] += 1
+        self._total_sent += 1
+        self._dirty_ports.add(port_num)
+
+
+# Performance statistics of a switch. Counters are updated for every frame, while time spent in stages of
+# send_frame (buffer flush, learning, aging, lookup and flooding) is only measured for every sample_every-th
+# frame to keep the overhead low. When statistics aren't collected, the only cost is a check in send_frame
+class PerfStats:
+
+    STAGES = ('flush', 'learn', 'aging', 'lookup', 'flood', 'batch')
+
+    def __init__(self, sample_every=100):
+        self.sample_every = max(int(sample_every), 1)
+        self.frames = 0
+        self.unicast = 0
+        self.floods = 0
+        self.multicast = 0
+        self.filtered = 0
+        self.flooded_copies = 0    # copies of flooded and multicast frames sent out of ports
+        self.evictions = 0         # MAC table entries removed by aging
+        self.buffer_depth = 0      # frames put in port buffers by the last frame
+        self.max_buffer_depth = 0
+        self.stage_calls = dict.fromkeys(self.STAGES, 0)    # number of timed calls per stage
+        self.stage_time = dict.fromkeys(self.STAGES, 0.0)   # total time of timed calls per stage, seconds
+
+    # Instrumented version of Switch.send_frame: calls the same stages of the switch with counters and sampled timers
+
+    def send_frame(self, switch, source_mac, dest_mac, port_num, vlan):
+        self.frames += 1
+        timed = self.frames % self.sample_every == 0
+        if timed:
+            stage_time = self.stage_time
+            start = perf_counter()
+        switch._new_epoch()
+        if timed:
+            now = perf_counter()
+            stage_time['flush'] += now - start
+            start = now
+        vlan = switch._learn_source(source_mac, port_num, vlan)
+        if timed:
+            now = perf_counter()
+            stage_time['learn'] += now - start
+            start = now
+        self.evictions += switch._remove_mac()
+        if timed:
+            now = perf_counter()
+            stage_time['aging'] += now - start
+            start = now
+        dest_entry = switch._lookup(dest_mac, port_num)
+        if timed:
+            now = perf_counter()
+            stage_time['lookup'] += now - start
+            start = now
+            for stage in ('flush', 'learn', 'aging', 'lookup'):
+                self.stage_calls[stage] += 1
+        if dest_entry is None:
+            decision, flooded = switch._forward_unknown(dest_mac, vlan, port_num)
+            if timed:
+                stage_time['flood'] += perf_counter() - start
+                self.stage_calls['flood'] += 1
+            if decision == FRAME_MULTICAST:
+                self.multicast += 1
+            else:
+                self.floods += 1
+            self.flooded_copies += flooded
+            self._buffered(flooded)
+            return decision
+        decision = switch._forward_known(dest_entry, dest_mac, vlan)
+        if decision == FRAME_FILTERED:
+            self.filtered += 1
+            self._buffered(0)
+        else:
+            self.unicast += 1
+            self._buffered(1)
+        return decision
+
+    # Add statistics collected by a shard of a switch's traffic (see Switch.send_frames_parallel)
+
+    def merge(self, other):
+        self.frames += other.frames
+        self.unicast += other.unicast
+        self.floods += other.floods
+        self.multicast += other.multicast
+        self.filtered += other.filtered
+        self.flooded_copies += other.flooded_copies
+        self.evictions += other.evictions
+        for stage in self.STAGES:
+            self.stage_calls[stage] += other.stage_calls[stage]
+            self.stage_time[stage] += other.stage_time[stage]
+
+    def _buffered(self, frames):
+        self.buffer_depth = frames
+        if frames > self.max_buffer_depth:
+            self.max_buffer_depth = frames
+
+    # Account for a batch of frames sent with Switch.send_frames
+
+    def record_batch(self, decisions, evictions, flooded_copies, elapsed):
+        self.frames += len(decisions)
+        floods = decisions.count(FRAME_FLOODED)
+        multicast = decisions.count(FRAME_MULTICAST)
+        filtered = decisions.count(FRAME_FILTERED)
+        self.floods += floods
+        self.multicast += multicast
+        self.filtered += filtered
+        self.unicast += len(decisions) - floods - multicast - filtered
+        self.evictions += evictions
+        self.flooded_copies += flooded_copies
+        self.stage_calls['batch'] += 1
+        self.stage_time['batch'] += elapsed
+
+    # All statistics of a switch as a dict
+
+    def report(self, switch):
+        return {
+            'frames': self.frames,
+            'unicast': self.unicast,
+            'floods': self.floods,
+            'multicast': self.multicast,
+            'filtered': self.filtered,
+            'flood_ratio': self.floods / self.frames if self.frames else 0.0,
+            'flooded_copies': self.flooded_copies,
+            'evictions': self.evictions,
+            'mac_table_size': len(switch.mac_table),
+            'mac_capacity': switch.mac_capacity,
+            'capacity_evictions': switch.mac_evictions,
+            'learn_failures': switch.learn_failures,
+            'buffer_depth': self.buffer_depth,
+            'max_buffer_depth': self.max_buffer_depth,
+            'sample_every': self.sample_every,
+            'stage_calls': dict(self.stage_calls),
+            'stage_time': dict(self.stage_time),
+        }
+
+    # Statistics as one JSON line
+
+    def to_jsonl(self, switch, sw_name):
+        record = {'switch': sw_name, 'time': time()}
+        record.update(self.report(switch))
+        return json.dumps(record) + '\n'
+
+    # Statistics in Prometheus text exposition format
+
+    def to_prometheus(self, switch, sw_name):
+        report = self.report(switch)
+        label = 'switch="{}"'.format(sw_name)
+        lines = []
+        for name, kind in (('frames', 'counter'), ('unicast', 'counter'), ('floods', 'counter'),
+                           ('multicast', 'counter'), ('filtered', 'counter'), ('flooded_copies', 'counter'), ('evictions', 'counter'),
+                           ('capacity_evictions', 'counter'), ('learn_failures', 'counter'),
+                           ('flood_ratio', 'gauge'), ('mac_table_size', 'gauge'), ('mac_capacity', 'gauge'),
+                           ('buffer_depth', 'gauge'), ('max_buffer_depth', 'gauge')):
+            if report[name] is None:
+                continue
+            metric = 'switchsim_{}{}'.format(name, '_total' if kind == 'counter' else '')
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            lines.append('{}{{{}}} {}'.format(metric, label, report[name]))
+        for name, values in (('stage_calls_total', report['stage_calls']), ('stage_seconds_total', report['stage_time'])):
+            lines.append('# TYPE switchsim_{} counter'.format(name))
+            for stage, value in values.items():
+                lines.append('switchsim_{}{{{},stage="{}"}} {}'.format(name, label, stage, value))
+        return '\n'.join(lines) + '\n'
 
 
-# This is a class for a network switch object
-class Switch(NetDevice):
+# Ports a frame of the default VLAN is flooded to (see Switch._flood_ports): all ports of a switch except ports
+# in other VLANs and blocked trunk ports. Only the excluded ports are kept, since listing the default VLAN would
+# take time and memory proportional to the number of ports of the switch
+class _DefaultVlanPorts:
 
-    # Create a switch with a num of ports provided
+    def __init__(self, num_ports, excluded):
+        self._num_ports = num_ports
+        self._excluded = frozenset(excluded)
 
-    def __init__(self, num_ports):
-        self.mac_table = {}
-        self.vlan_db = {'vlan1': set()}
-        super().__init__(num_ports)
-        for port in self.ports:
-            self.vlan_db['vlan1'].add(port)
+    def __contains__(self, port_num):
+        return 0 <= port_num < self._num_ports and port_num not in self._excluded
 
-    # Learn a new MAC address
+    def __len__(self):
+        return self._num_ports - len(self._excluded)
 
-    def _learn_mac(self, source_mac, port_num):
-        if source_mac not in self.mac_table:
-            port_vlan = ''
-            for vlan in self.vlan_db:
-                if 'port_{}'.format(port_num) in self.vlan_db[vlan]:
-                    port_vlan = vlan
-                    break
-            self.mac_table[source_mac] = [port_num, 0, port_vlan]
+    def __iter__(self):
+        return (port for port in range(self._num_ports) if port not in self._excluded)
+
+
+# This is a class for a network switch object
+class Switch(NetDevice):
+
+    # Policies of choosing which MAC address leaves a full MAC table when a new one is learned: the least recently
+    # seen one, the one learned first, or none, so that new addresses aren't learned (see _choose_victim)
+    MAC_EVICTION = ('lru', 'oldest', 'refuse')
+
+    # Key of the flood counter of forwarding trunk ports, which get floods of every VLAN (see _flood)
+    _TRUNK_FLOODS = 'trunks'
+
+    # Create a switch with a num of ports provided; aging_time is a number of steps after which
+    # a MAC address which hasn't been seen by the switch is removed from its MAC table
+
+    def __init__(self, num_ports, aging_time=5, mac_capacity=None, mac_eviction='lru'):
+        if aging_time < 1:
+            raise ValueError("Aging time must be a positive number of steps")
+        # MAC table maps MAC addresses to MacEntry records; the table is kept ordered by the step when a MAC
+        # was last seen, so the entries which are about to expire are always at the front
+        self.mac_table = OrderedDict()
+        self.aging_time = aging_time
+        self._clock = 0    # logical clock, counts steps (frames) processed by the switch
+        # VLAN number -> ports of the VLAN. VLAN 1 is the default VLAN: every port which isn't in another VLAN and
+        # isn't a trunk port belongs to it implicitly, so its set is always empty and its ports aren't listed
+        self.vlan_db = {1: set()}
+        self._vlan_view = None     # cached sorted view of vlan_db, see vlan_database
+        super().__init__(num_ports)
+        self._port_vlan = {}       # reverse index of vlan_db: port -> VLAN, for ports outside the default VLAN
+        # Trunk ports carry frames of all VLANs to other switches: port -> True if the port is forwarding,
+        # False if it's blocked to break a loop (see Fabric)
+        self.trunk_ports = {}
+        self.mcast_groups = {}     # multicast group MAC -> ports which joined the group
+        # Cached egress ports of floods and multicast frames; dropped whenever VLANs, trunks or groups change
+        self._flood_sets = {}      # VLAN -> frozenset of ports, see _flood_ports
+        self._group_sets = {}      # (group MAC, VLAN) -> frozenset of ports, see _group_ports
+        # Floods update counters in bulk: every port follows the counter of frames flooded to its VLAN (forwarding
+        # trunks follow the counter of all floods), and its counter of sent frames is brought up to date only
+        # when it's read or the port changes its VLAN (see _settle_port). _flood_base holds the value of the
+        # followed counter the port's sent frames include; a port without a slot has got every flood of its VLAN
+        self._flood_counts = {}    # VLAN or _TRUNK_FLOODS -> number of frames flooded
+        self._sampled_floods = {}  # flood counters when changed ports were last taken, see _take_changed_ports
+        self._flood_base = array('Q')
+        # The last flooded or multicast frame is kept once for all its egress ports instead of a copy in every
+        # port buffer: (epoch, egress ports, ingress port, destination MAC, VLAN, FRAME_FLOODED or FRAME_MULTICAST),
+        # plus ports which already pulled it
+        self._flood_frame = None
+        self._flood_pulled = set()
+        self.perf = None    # PerfStats collecting performance statistics, if enabled (see enable_perf)
+        self.mac_capacity = None
+        self.mac_eviction = 'lru'
+        self.mac_evictions = 0     # entries removed from a full MAC table to learn new addresses
+        self.learn_failures = 0    # addresses not learned because a full MAC table refused them
+        self._free_entries = None  # preallocated MacEntry records not used by the MAC table, if it's bounded
+        self._learned = None       # MAC addresses in order of learning, kept for the 'oldest' eviction policy
+        if mac_capacity is not None:
+            self.set_mac_capacity(mac_capacity, mac_eviction)
+
+    # Limit the MAC table to a number of entries, like a CAM of a real switch, with a policy of making room for new
+    # addresses (see MAC_EVICTION); None makes the table unbounded. Records for all entries are allocated up front
+    # and reused, so a bounded table never allocates memory. Entries over a new capacity are removed in LRU order
+
+    def set_mac_capacity(self, capacity, eviction='lru'):
+        if eviction not in self.MAC_EVICTION:
+            raise ValueError("Eviction policy must be one of: {}".format(', '.join(self.MAC_EVICTION)))
+        if capacity is not None and capacity < 1:
+            raise ValueError("MAC table capacity must be at least 1")
+        self._revision += 1
+        self.mac_capacity = capacity
+        self.mac_eviction = eviction
+        if capacity is None:
+            self._free_entries = None
+            self._learned = None
+            return
+        mac_table = self.mac_table
+        while len(mac_table) > capacity:
+            del mac_table[next(iter(mac_table))]
+        self._free_entries = [MacEntry(0, 0, 0) for _ in range(capacity - len(mac_table))]
+        self._learned = dict.fromkeys(mac_table) if eviction == 'oldest' else None
+
+    # Choose an entry to remove from a full MAC table; returns its MAC address, or None to refuse a new address.
+    # Subclasses can override it to try other policies
+
+    def _choose_victim(self):
+        if self.mac_eviction == 'lru':
+            return next(iter(self.mac_table))
+        if self.mac_eviction == 'oldest':
+            # MAC addresses removed by aging are left in _learned and skipped here
+            learned = self._learned
+            while True:
+                mac = next(iter(learned))
+                del learned[mac]
+                if mac in self.mac_table:
+                    return mac
+        return None
+
+    # Add an entry to a bounded MAC table, making room according to the eviction policy if it's full; returns
+    # the new entry or None if the address is refused
+
+    def _add_entry(self, mac, port, stamp, vlan):
+        mac_table = self.mac_table
+        if len(mac_table) >= self.mac_capacity:
+            victim = self._choose_victim()
+            if victim is None:
+                self.learn_failures += 1
+                return None
+            entry = mac_table.pop(victim)
+            self.mac_evictions += 1
+        else:
+            entry = self._free_entries.pop()
+        entry.port = port
+        entry.stamp = stamp
+        entry.vlan = vlan
+        mac_table[mac] = entry
+        learned = self._learned
+        if learned is not None:
+            learned.pop(mac, None)
+            learned[mac] = None
+            if len(learned) > 2 * self.mac_capacity:
+                self._learned = {mac: None for mac in learned if mac in mac_table}
+        return entry
+
+    # Remove an entry from the MAC table, keeping its record for reuse if the table is bounded
+
+    def _drop_entry(self, mac):
+        entry = self.mac_table.pop(mac)
+        if self._free_entries is not None:
+            self._free_entries.append(entry)
+
+    # VLAN of a frame: the VLAN its source MAC address was learned in, or the VLAN of the ingress port (or the tag
+    # of a frame coming from a trunk) if the address isn't in the MAC table
+
+    def _source_vlan(self, source_mac, port_num, vlan=None):
+        entry = self.mac_table.get(source_mac)
+        if entry is not None:
+            return entry.vlan
+        return self._vlan_of(port_num) if vlan is None else vlan
+
+    # VLAN of a port: trunk ports and ports which aren't in any other VLAN are in the default VLAN 1;
+    # frames from ports the switch doesn't have get VLAN 0
+
+    def _vlan_of(self, port_num):
+        vlan = self._port_vlan.get(port_num)
+        if vlan is None:
+            return 1 if 0 <= port_num < self.num_ports else 0
+        return vlan
+
+    # Turn collecting performance statistics on (with stages of every sample_every-th frame timed) or off
+
+    def enable_perf(self, sample_every=100):
+        self.perf = PerfStats(sample_every)
+
+    def disable_perf(self):
+        self.perf = None
+
+    # Learn a new MAC address; frames received on trunk ports carry a VLAN tag, frames received on access ports
+    # belong to the port's VLAN
+
+    def _learn_mac(self, source_mac, port_num, vlan=None):
+        entry = self.mac_table.get(source_mac)
+        if entry is not None and entry.stamp < self._clock - self.aging_time:
+            # The entry had expired before this step; possible only when steps are skipped (see send_frames)
+            self._drop_entry(source_mac)
+            entry = None
+        if entry is None:
+            if vlan is None:
+                vlan = self._vlan_of(port_num)
+            if self.mac_capacity is None:
+                entry = self.mac_table[source_mac] = MacEntry(port_num, self._clock, vlan)
+            else:
+                entry = self._add_entry(source_mac, port_num, self._clock, vlan)
+        return entry
 
-    # Update timers of MAC table entries
+    # Update timers of MAC table entries: only the source MAC is stamped with the current step,
+    # ages of all other entries grow implicitly as the clock goes on
 
     def _update_timers(self, source_mac):
-        self.mac_table[source_mac][1] = 0
-        for mac in self.mac_table:
-            if mac != source_mac:
-                self.mac_table[mac][1] += 1
+        self.mac_table[source_mac].stamp = self._clock
+        self.mac_table.move_to_end(source_mac)
 
     # Remove outdated records: after 5 steps (where each step is sending 1 frame by command 'send';
     # if multiple frames're sent at a time, it counts as several steps) a record for a MAC, which hasn't been
-    # seen by the switch during 5 steps, will be removed from the switch's MAC table
+    # seen by the switch during 5 steps, will be removed from the switch's MAC table.
+    # Since the table is ordered by the last-seen step, only expired entries at its front are visited
 
     def _remove_mac(self):
-        for_removal = []
-        for mac in self.mac_table:
-            if self.mac_table[mac][1] >= 5:
-                for_removal.append(mac)
-        for mac in for_removal:
-            del self.mac_table[mac]
+        expired = self._clock - self.aging_time
+        removed = 0
+        while self.mac_table:
+            mac = next(iter(self.mac_table))
+            if self.mac_table[mac].stamp > expired:
+                break
+            self._drop_entry(mac)
+            removed += 1
+        return removed
+
+    # Number of steps since a MAC address in the MAC table was last seen by the switch
+
+    def get_mac_age(self, mac):
+        return self._clock - self.mac_table[mac].stamp
 
     # This method clears a port buffer for a particular port; it's used to remove frames which were not "pulled"
-    # by connected hosts; that means that those frames were lost in transit
+    # by connected hosts; that means that those frames were lost in transit. All buffers are cleared at once
+    # at the start of every frame by starting a new epoch (see NetDevice._new_epoch)
 
     def flush_buffer(self, port_num):
-        self.ports['port_{}'.format(port_num)]['sent_frames']['buffer'] = []
+        slot = self._slots.get(int(port_num))
+        if slot is not None:
+            self._buffer_epochs[slot] = -1
+        if self._flood_buffered(int(port_num)):
+            self._flood_pulled.add(int(port_num))
+        self._revision += 1
 
-    # Provides details about port-to-VLAN associations:
+    # Provides details about port-to-VLAN associations; the sorted view is built once and reused
+    # until VLANs or their ports are changed
 
     @property
     def vlan_database(self):
-        vlans = {}
-        for vlan in self.vlan_db:
-            vlans[vlan] = list(self.vlan_db[vlan])
-            vlans[vlan].sort()
-        return vlans
-
-    # This method provides an interface for workstations to send their frames
-
-    def send_frame(self, source_mac, dest_mac, port_num):
-        for port in self.ports:
-            number = port.split('_')[1]
-            self.flush_buffer(number)
-        self._learn_mac(source_mac, port_num)
-        self._update_timers(source_mac)
+        if self._vlan_view is None:
+            vlans = {}
+            for vlan in self.vlan_db:
+                vlans[vlan] = list(self.vlan_db[vlan])
+                vlans[vlan].sort()
+            vlans[1] = [port for port in range(self.num_ports)
+                        if port not in self._port_vlan and port not in self.trunk_ports]
+            self._vlan_view = vlans
+        return self._vlan_view
+
+    # Ports a frame of a VLAN is flooded to: ports of the VLAN plus forwarding trunk ports. The set is built once
+    # per VLAN and reused until VLANs or trunks change (see _topology_changed)
+
+    def _flood_ports(self, vlan):
+        ports = self._flood_sets.get(vlan)
+        if ports is None:
+            if vlan == 1:
+                excluded = set(self._port_vlan)
+                excluded.update(port for port, forwarding in self.trunk_ports.items() if not forwarding)
+                ports = _DefaultVlanPorts(self.num_ports, excluded)
+            else:
+                ports = set(self.vlan_db.get(vlan, ()))
+                ports.update(port for port, forwarding in self.trunk_ports.items() if forwarding)
+                ports = frozenset(ports)
+            self._flood_sets[vlan] = ports
+        return ports
+
+    # Ports a frame to a multicast group is sent to: ports of the frame's VLAN which joined the group, plus
+    # forwarding trunk ports, which lead to other members of the group
+
+    def _group_ports(self, group, vlan):
+        ports = self._group_sets.get((group, vlan))
+        if ports is None:
+            ports = set(port for port in self.mcast_groups.get(group, ())
+                        if self._vlan_of(port) == vlan and port not in self.trunk_ports)
+            ports.update(port for port, forwarding in self.trunk_ports.items() if forwarding)
+            ports = self._group_sets[(group, vlan)] = frozenset(ports)
+        return ports
+
+    # Drop cached egress ports after a change of VLANs, trunks or multicast groups
+
+    def _topology_changed(self):
+        self._flood_sets = {}
+        self._group_sets = {}
+        self._vlan_view = None
+        self._revision += 1
+
+    # The flood counter a port follows (see _flood_base); blocked trunk ports don't get floods at all
+
+    def _flood_key(self, port_num):
+        forwarding = self.trunk_ports.get(port_num)
+        if forwarding is None:
+            return self._vlan_of(port_num)
+        return self._TRUNK_FLOODS if forwarding else None
+
+    # Add floods a port got since its counter was last brought up to date; returns the port's slot. Before a port
+    # changes its VLAN or becomes a trunk it's settled, and then it follows its new counter from its current value
+    # (see _rebase_port)
+
+    def _settle_port(self, port_num):
+        slot = self._slot(port_num)
+        followed = self._flood_counts.get(self._flood_key(port_num), 0)
+        pending = followed - self._flood_base[slot]
+        if pending:
+            self._sent[slot] += pending
+            self._flood_base[slot] = followed
+            self._dirty_ports.add(port_num)
+        return slot
+
+    def _rebase_port(self, port_num):
+        self._flood_base[self._slot(port_num)] = self._flood_counts.get(self._flood_key(port_num), 0)
+
+    # Bring counters of all ports with slots up to date, e.g. before the whole array of counters is read
+
+    def _settle_floods(self):
+        for port in self._slots:
+            self._settle_port(port)
+
+    def _add_port(self, port_num):
+        slot = super()._add_port(port_num)
+        self._flood_base.append(0)
+        return slot
+
+    # Floods don't mark ports as changed one by one: ports which follow a flood counter changed since the last
+    # call are added here. A port which left a VLAN since then was settled and marked when it left
+
+    def _take_changed_ports(self):
+        ports = super()._take_changed_ports()
+        sampled = self._sampled_floods
+        for key, frames in self._flood_counts.items():
+            if sampled.get(key) != frames:
+                if key == self._TRUNK_FLOODS:
+                    ports.update(port for port, forwarding in self.trunk_ports.items() if forwarding)
+                else:
+                    ports.update(self._flood_ports(key))
+        self._sampled_floods = dict(self._flood_counts)
+        return ports
+
+    # A port without a slot has only got floods, so its counter isn't created just to be read
+
+    def get_sent_for_port(self, port_num):
+        port_num = int(port_num)
+        if port_num not in self._slots:
+            if not 0 <= port_num < self.num_ports:
+                return 0
+            return self._flood_counts.get(self._flood_key(port_num), 0)
+        return self._sent[self._settle_port(port_num)]
+
+    # Turn a port into a trunk port; untagged frames received on a trunk port belong to VLAN 1 (native VLAN)
+
+    def set_trunk(self, port_num, forwarding=True):
+        port_num = int(port_num)
+        self._settle_port(port_num)
+        if port_num not in self.trunk_ports:
+            self.vlan_db[self._vlan_of(port_num)].discard(port_num)
+            self._port_vlan.pop(port_num, None)
+        self.trunk_ports[port_num] = forwarding
+        self._rebase_port(port_num)
+        self._topology_changed()
+
+    # Join a switch port to a multicast group, or remove it from the group
+
+    def join_group(self, group, port_num):
+        self.mcast_groups.setdefault(group, set()).add(int(port_num))
+        self._topology_changed()
+
+    def leave_group(self, group, port_num):
+        ports = self.mcast_groups.get(group)
+        if ports is not None:
+            ports.discard(int(port_num))
+            if not ports:
+                del self.mcast_groups[group]
+            self._topology_changed()
+
+    # The last flooded or multicast frame is in a port's buffer if the port is one of the frame's egress ports
+    # and hasn't pulled the frame yet
+
+    def _flood_buffered(self, port_num, dest_mac=None):
+        frame = self._flood_frame
+        return (frame is not None and frame[0] == self._epoch and port_num in frame[1] and port_num != frame[2]
+                and (dest_mac is None or dest_mac == frame[3]) and port_num not in self._flood_pulled)
+
+    def _buffer_flood(self, ports, port_num, dest_mac, vlan, decision):
+        self._flood_frame = (self._epoch, ports, port_num, dest_mac, vlan, decision)
+        self._flood_pulled = set()
+
+    def get_buffered_for_port(self, port_num):
+        buffered = super().get_buffered_for_port(port_num)
+        if self._flood_buffered(int(port_num)):
+            dest_mac = self._flood_frame[3]
+            buffered[dest_mac] = buffered.get(dest_mac, 0) + 1
+        return buffered
+
+    def pull_frames(self, port_num, dest_mac):
+        frames = super().pull_frames(port_num, dest_mac)
+        if self._flood_buffered(port_num, dest_mac):
+            self._flood_pulled.add(port_num)
+            self._revision += 1
+            frames += 1
+        return frames
+
+    # This method provides an interface for workstations to send their frames; returns a forwarding decision:
+    # an egress port number, FRAME_FLOODED or FRAME_FILTERED. Frames coming from other switches over trunk ports
+    # are given with their VLAN tag
+
+    def send_frame(self, source_mac, dest_mac, port_num, vlan=None):
+        if not 0 <= port_num < self.num_ports:
+            raise IndexError("Port {} doesn't exist".format(port_num))
+        if self.perf is not None:
+            return self.perf.send_frame(self, source_mac, dest_mac, port_num, vlan)
+        self._new_epoch()
+        vlan = self._learn_source(source_mac, port_num, vlan)
         self._remove_mac()
+        dest_entry = self._lookup(dest_mac, port_num)
+        if dest_entry is None:
+            return self._forward_unknown(dest_mac, vlan, port_num)[0]
+        return self._forward_known(dest_entry, dest_mac, vlan)
+
+    # Stages of send_frame, also called by PerfStats.send_frame. Buffer flush is _new_epoch and aging is _remove_mac.
+    # Learning takes the next step of the clock and returns the frame's VLAN
+
+    def _learn_source(self, source_mac, port_num, vlan):
+        self._clock += 1
+        # Group addresses are never learned: they can't be the source of a frame
+        if not source_mac & GROUP_BIT:
+            source_entry = self._learn_mac(source_mac, port_num, vlan)
+            if source_entry is not None:
+                self._update_timers(source_mac)
+                return source_entry.vlan
+        if vlan is None:
+            # The address is a group address or the MAC table is full and refused it
+            return self._vlan_of(port_num)
+        return vlan
+
+    # Count the received frame and look its destination up in the MAC table; returns the entry or None
+
+    def _lookup(self, dest_mac, port_num):
         self.receive(port_num)
-        if dest_mac in self.mac_table:
-            if self.mac_table[source_mac][2] == self.mac_table[dest_mac][2]:
-                self.send(self.mac_table[dest_mac][0])
-                self.ports['port_{}'.format(self.mac_table[dest_mac][0])]['sent_frames']['buffer'].append(dest_mac)
-        else:
-            for port in self.vlan_db[self.mac_table[source_mac][2]]:
-                if port != 'port_{}'.format(port_num):
-                    self.ports[port]['sent_frames']['buffer'].append(dest_mac)
-                    self.ports[port]['sent_frames']['sent'] += 1
+        return self.mac_table.get(dest_mac)
+
+    # Send a frame to a known MAC address if it's in the same VLAN; returns a forwarding decision
+
+    def _forward_known(self, dest_entry, dest_mac, vlan):
+        if dest_entry.vlan != vlan:
+            return FRAME_FILTERED
+        dest_port = dest_entry.port
+        self.send(dest_port)
+        self._buffer_frame(dest_port, dest_mac)
+        return dest_port
+
+    # Send a frame to an unknown MAC address to a multicast group or flood it; returns a forwarding decision
+    # and a number of copies sent
+
+    def _forward_unknown(self, dest_mac, vlan, port_num):
+        if dest_mac in self.mcast_groups:
+            return FRAME_MULTICAST, self._multicast(dest_mac, vlan, port_num)
+        return FRAME_FLOODED, self._flood(vlan, dest_mac, port_num)
+
+    # Flood a frame to all ports of a VLAN except the port it came from; returns a number of copies sent.
+    # Only the VLAN's flood counter is updated, and the frame is buffered once for all ports, so a flood
+    # takes the same time whatever the size of the VLAN
+
+    def _flood(self, vlan, dest_mac, port_num):
+        ports = self._flood_ports(vlan)
+        flooded = len(ports)
+        if port_num in ports:
+            # The port the frame came from follows the counter too, so it skips this flood
+            self._flood_base[self._settle_port(port_num)] += 1
+            flooded -= 1
+        counts = self._flood_counts
+        counts[vlan] = counts.get(vlan, 0) + 1
+        counts[self._TRUNK_FLOODS] = counts.get(self._TRUNK_FLOODS, 0) + 1
+        self._total_sent += flooded
+        self._buffer_flood(ports, port_num, dest_mac, vlan, FRAME_FLOODED)
+        return flooded
+
+    # Send a frame to ports of a multicast group (see _group_ports) except the port it came from; returns
+    # a number of copies sent
+
+    def _multicast(self, group, vlan, port_num):
+        ports = self._group_ports(group, vlan)
+        sent = self._sent
+        slot = self._slot
+        copies = 0
+        for port in ports:
+            if port != port_num:
+                sent[slot(port)] += 1
+                copies += 1
+        self._total_sent += copies
+        self._dirty_ports.update(ports)
+        self._buffer_flood(ports, port_num, group, vlan, FRAME_MULTICAST)
+        return copies
+
+    # Bulk version of send_frame: processes a batch of frames given as sequences of source MACs, destination MACs
+    # and ingress ports, and returns a list of forwarding decisions, one per frame. The result (decisions, counters,
+    # MAC table and port buffers) is the same as calling send_frame for every frame in order, but counters are
+    # updated once per batch: received frames are summed up per port and floods are summed up per VLAN.
+    # Since every frame flushes port buffers, only the frame processed last is left in the buffers.
+    # By default frames take consecutive steps of the switch's clock; steps (increasing numbers) can be given
+    # explicitly to run a part of the switch's traffic separately, see send_frames_parallel
+
+    def send_frames(self, source_macs, dest_macs, port_nums, steps=None):
+        start = perf_counter() if self.perf is not None else 0
+        self._check_ports(port_nums)
+        mac_table = self.mac_table
+        vlan_of = self._vlan_of
+        move_to_end = mac_table.move_to_end
+        aging_time = self.aging_time
+        bounded = self.mac_capacity is not None
+        free = self._free_entries
+        clock = self._clock
+        received = {}
+        floods = {}              # VLAN -> number of frames flooded to it
+        flood_sources = {}       # (VLAN, ingress port) -> number of frames flooded to the VLAN from that port
+        unicast = {}             # egress port -> number of frames sent out of it
+        multicast = {}           # (group MAC, VLAN, ingress port) -> number of frames sent to the group
+        mcast_groups = self.mcast_groups
+        decisions = []
+        last = None
+        evictions = 0
+        if steps is None:
+            steps = count(clock + 1)
+        for source_mac, dest_mac, port_num, clock in zip(source_macs, dest_macs, port_nums, steps):
+            # Learning and aging, see _learn_source and _remove_mac
+            source_entry = mac_table.get(source_mac)
+            if source_entry is not None and source_entry.stamp < clock - aging_time:
+                self._drop_entry(source_mac)
+                source_entry = None
+            if source_entry is None:
+                vlan = vlan_of(port_num)
+                # Group addresses are never learned
+                if not source_mac & GROUP_BIT:
+                    if bounded:
+                        source_entry = self._add_entry(source_mac, port_num, clock, vlan)
+                    else:
+                        source_entry = mac_table[source_mac] = MacEntry(port_num, clock, vlan)
+            else:
+                source_entry.stamp = clock
+                move_to_end(source_mac)
+                vlan = source_entry.vlan
+            expired = clock - aging_time
+            while mac_table:
+                mac = next(iter(mac_table))
+                if mac_table[mac].stamp > expired:
+                    break
+                entry = mac_table.pop(mac)
+                if bounded:
+                    free.append(entry)
+                evictions += 1
+            # Forwarding
+            received[port_num] = received.get(port_num, 0) + 1
+            dest_entry = mac_table.get(dest_mac)
+            if dest_entry is None:
+                if dest_mac in mcast_groups:
+                    decision = FRAME_MULTICAST
+                    key = (dest_mac, vlan, port_num)
+                    multicast[key] = multicast.get(key, 0) + 1
+                else:
+                    decision = FRAME_FLOODED
+                    floods[vlan] = floods.get(vlan, 0) + 1
+                    key = (vlan, port_num)
+                    flood_sources[key] = flood_sources.get(key, 0) + 1
+            elif dest_entry.vlan == vlan:
+                decision = dest_entry.port
+                unicast[decision] = unicast.get(decision, 0) + 1
+            else:
+                decision = FRAME_FILTERED
+            decisions.append(decision)
+            last = (dest_mac, port_num, vlan, decision)
+        if last is None:
+            return decisions
+        self._clock = clock
+        # Apply counters for the whole batch
+        sent = self._sent
+        slot = self._slot
+        total_sent = 0
+        for port, frames in received.items():
+            self._received[slot(port)] += frames
+            self._total_received += frames
+        for port, frames in unicast.items():
+            sent[slot(port)] += frames
+            total_sent += frames
+        for (group, vlan, port_num), frames in multicast.items():
+            for port in self._group_ports(group, vlan):
+                if port != port_num:
+                    sent[slot(port)] += frames
+                    total_sent += frames
+                    self._dirty_ports.add(port)
+        self._dirty_ports.update(received)
+        self._dirty_ports.update(unicast)
+        # Floods only add to flood counters (see _flood); ports floods came from skip them
+        flood_ports = {vlan: self._flood_ports(vlan) for vlan in floods}
+        flood_base = self._flood_base
+        source_slots = {}
+        for vlan, port in flood_sources:
+            if port in flood_ports[vlan]:
+                source_slots[port] = self._settle_port(port)
+        counts = self._flood_counts
+        for vlan, frames in floods.items():
+            counts[vlan] = counts.get(vlan, 0) + frames
+            counts[self._TRUNK_FLOODS] = counts.get(self._TRUNK_FLOODS, 0) + frames
+            total_sent += frames * len(flood_ports[vlan])
+        for (vlan, port), frames in flood_sources.items():
+            if port in flood_ports[vlan]:
+                flood_base[source_slots[port]] += frames
+                total_sent -= frames
+        self._total_sent += total_sent
+        # Leave only the last frame in port buffers
+        self._epoch += len(decisions)
+        dest_mac, port_num, vlan, decision = last
+        buffered = 0
+        if decision == FRAME_FLOODED or decision == FRAME_MULTICAST:
+            ports = flood_ports[vlan] if decision == FRAME_FLOODED else self._group_ports(dest_mac, vlan)
+            self._buffer_flood(ports, port_num, dest_mac, vlan, decision)
+            buffered = len(ports) - (port_num in ports)
+        elif decision != FRAME_FILTERED:
+            self._buffer_frame(decision, dest_mac)
+            buffered = 1
+        if self.perf is not None:
+            flooded = total_sent - sum(unicast.values())
+            self.perf.record_batch(decisions, evictions, flooded, perf_counter() - start)
+            # The deepest buffering in the batch: a flood to the biggest VLAN, or a single unicast frame
+            for vlan, port in flood_sources:
+                self.perf._buffered(len(flood_ports[vlan]) - (port in flood_ports[vlan]))
+            if unicast:
+                self.perf._buffered(1)
+            self.perf._buffered(buffered)
+        return decisions
+
+    # Ingress ports of a batch are checked before any frame changes the switch, so a bad port leaves it as it was
+
+    def _check_ports(self, port_nums):
+        if port_nums and (min(port_nums) < 0 or max(port_nums) >= self.num_ports):
+            port = next(port for port in port_nums if not 0 <= port < self.num_ports)
+            raise IndexError("Port {} doesn't exist".format(port))
+
+    # Split frames into groups which can be processed independently: frames of different groups share no MAC
+    # addresses and no VLANs, since a VLAN is a separate broadcast and learning domain. Such groups only share
+    # the switch's clock, which is kept by giving every frame its step explicitly (see send_frames).
+    # VLANs which share a MAC address are joined into one group using a union-find forest of VLANs; group addresses
+    # are never learned (see _learn_source), so they don't join VLANs. The VLAN of every frame comes from a table of
+    # the ingress ports, and every MAC address gets one VLAN it was seen in: only frames where a MAC address is seen
+    # in another VLAN are visited one by one, the rest of the frames only go through built-in functions.
+    # Groups are packed into at most `parts` shards of similar size; returns (frame indices, MAC addresses) per shard
+
+    def _split_domains(self, source_macs, dest_macs, port_nums, parts):
+        parents = {}
+
+        def find(vlan):
+            parents.setdefault(vlan, vlan)
+            while parents[vlan] != vlan:
+                parents[vlan] = parents[parents[vlan]]
+                vlan = parents[vlan]
+            return vlan
+
+        def union(vlan, other):
+            root, other_root = find(vlan), find(other)
+            if root != other_root:
+                parents[other_root] = root
+
+        vlan_of = self._vlan_of
+        port_frames = Counter(port_nums)
+        port_vlans = {port: vlan_of(port) for port in port_frames}
+        vlans = list(map(port_vlans.__getitem__, port_nums))
+        mac_vlans = dict(zip(source_macs, vlans))     # MAC -> one of the VLANs the MAC was seen in
+        mac_vlans.update(zip(dest_macs, vlans))
+        for mac in [mac for mac in mac_vlans if mac & GROUP_BIT]:
+            del mac_vlans[mac]
+        # Group addresses aren't in mac_vlans, so get() gives them the VLAN of their frame and they never differ
+        for macs in (source_macs, dest_macs):
+            for index in compress(count(), map(ne, map(mac_vlans.get, macs, vlans), vlans)):
+                union(mac_vlans[macs[index]], vlans[index])
+        # A MAC address learned in another VLAN before the batch also joins the VLANs
+        mac_table = self.mac_table
+        for mac in mac_vlans.keys() & mac_table.keys():
+            if mac_table[mac].vlan != mac_vlans[mac]:
+                union(mac_table[mac].vlan, mac_vlans[mac])
+        groups = {}          # root VLAN -> number of frames of the group
+        for port, frames in port_frames.items():
+            root = find(port_vlans[port])
+            groups[root] = groups.get(root, 0) + frames
+        # Pack the groups into shards, the biggest groups first, every group into the smallest shard so far
+        sizes = [0] * min(parts, len(groups))
+        shard_of = {}
+        for root, frames in sorted(groups.items(), key=lambda item: item[1], reverse=True):
+            shard = shard_of[root] = sizes.index(min(sizes))
+            sizes[shard] += frames
+        if len(sizes) == 1:
+            return [(list(range(len(vlans))), set(mac_vlans))]
+        vlan_shards = {vlan: shard_of[find(vlan)] for vlan in port_vlans.values()}
+        # Frame indices sorted by shard: a stable sort keeps the order of frames within every shard
+        frame_shards = list(map(vlan_shards.__getitem__, vlans))
+        order = sorted(range(len(vlans)), key=frame_shards.__getitem__)
+        shards = []
+        start = 0
+        for size in sizes:
+            shards.append((order[start:start + size], set()))
+            start += size
+        for mac, vlan in mac_vlans.items():
+            shards[vlan_shards[vlan]][1].add(mac)
+        return shards
+
+    # Prepare separate parts of a switch's traffic split by _split_domains: returns (frame indices, MAC addresses,
+    # arguments for _run_shard) per shard. Every shard gets a copy of the switch with zero counters and only
+    # the MAC table entries of its own MAC addresses
+
+    def _plan_shards(self, source_macs, dest_macs, port_nums, shards):
+        plan = []
+        for indices, macs in shards:
+            shard = Switch(0, self.aging_time)
+            shard.num_ports = self.num_ports
+            shard.vlan_db = self.vlan_db
+            shard._port_vlan = self._port_vlan
+            shard.trunk_ports = self.trunk_ports
+            shard.mcast_groups = self.mcast_groups
+            if self.perf is not None:
+                shard.enable_perf(self.perf.sample_every)
+            entries = [(mac, self.mac_table[mac].copy()) for mac in macs if mac in self.mac_table]
+            entries.sort(key=lambda item: item[1].stamp)
+            shard.mac_table = OrderedDict(entries)
+            plan.append((indices, macs, (shard, self._clock, indices,
+                                         list(map(source_macs.__getitem__, indices)),
+                                         list(map(dest_macs.__getitem__, indices)),
+                                         list(map(port_nums.__getitem__, indices)))))
+        return plan
+
+    # Merge results of shards back into the switch; the state of the switch is the same as if all frames
+    # were sent with send_frames. Returns forwarding decisions for all frames.
+    # Floods of a shard are added to the switch's flood counters; counters of ports which the shard has slots for
+    # already include the floods, so only the rest of their frames is added to the ports
+
+    def _merge_shards(self, source_macs, dest_macs, port_nums, plan, results):
+        decisions = [None] * len(source_macs)
+        mac_table = self.mac_table
+        counts = self._flood_counts
+        for (indices, macs, _), (shard_decisions, sent, received, entries, perf, floods, total_sent) \
+                in zip(plan, results):
+            if self.perf is not None and perf is not None:
+                self.perf.merge(perf)
+            for index, decision in zip(indices, shard_decisions):
+                decisions[index] = decision
+            for key, frames in floods.items():
+                counts[key] = counts.get(key, 0) + frames
+            for port, frames in sent.items():
+                slot = self._settle_port(port)
+                self._sent[slot] += frames - floods.get(self._flood_key(port), 0)
+            self._total_sent += total_sent
+            for port, frames in received.items():
+                self._received[self._slot(port)] += frames
+                self._total_received += frames
+            self._dirty_ports.update(sent)
+            self._dirty_ports.update(received)
+            for mac in macs:
+                mac_table.pop(mac, None)
+            mac_table.update(entries)
+        self.mac_table = OrderedDict(sorted(mac_table.items(), key=lambda item: item[1].stamp))
+        self._clock += len(decisions)
+        evictions = self._remove_mac()
+        # Leave only the last frame in port buffers
+        self._epoch += len(decisions)
+        decision = decisions[-1]
+        buffered = 0
+        if decision == FRAME_FLOODED or decision == FRAME_MULTICAST:
+            vlan = self._source_vlan(source_macs[-1], port_nums[-1])
+            if decision == FRAME_FLOODED:
+                ports = self._flood_ports(vlan)
+            else:
+                ports = self._group_ports(dest_macs[-1], vlan)
+            self._buffer_flood(ports, port_nums[-1], dest_macs[-1], vlan, decision)
+            buffered = len(ports) - (port_nums[-1] in ports)
+        elif decision != FRAME_FILTERED:
+            self._buffer_frame(decision, dest_macs[-1])
+            buffered = 1
+        if self.perf is not None:
+            self.perf.evictions += evictions
+            self.perf._buffered(buffered)
+        return decisions
+
+    # Parallel version of send_frames: frames are split by VLAN domains (see _split_domains) and the domains
+    # are processed by a pool of worker processes (see _worker_pool). The result is exactly the same as of
+    # send_frames. A bounded MAC table is shared by all VLANs, so such a switch processes its frames with
+    # send_frames, as does a switch with one worker or with traffic of one domain
+
+    def send_frames_parallel(self, source_macs, dest_macs, port_nums, workers=None):
+        source_macs, dest_macs, port_nums = list(source_macs), list(dest_macs), list(port_nums)
+        self._check_ports(port_nums)
+        workers = workers or cpu_count() or 1
+        if self.mac_capacity is not None or workers == 1 or not source_macs:
+            return self.send_frames(source_macs, dest_macs, port_nums)
+        shards = self._split_domains(source_macs, dest_macs, port_nums, workers)
+        if len(shards) == 1:
+            return self.send_frames(source_macs, dest_macs, port_nums)
+        plan = self._plan_shards(source_macs, dest_macs, port_nums, shards)
+        results = list(_worker_pool(workers).map(_run_shard, *zip(*(shard for _, _, shard in plan))))
+        return self._merge_shards(source_macs, dest_macs, port_nums, plan, results)
+
+    # Binary record of the switch's state used by snapshots (see RuntimeEnv.save): a header of _RECORD_HEADER
+    # followed by flat little-endian arrays: ports which have slots, and per slot counters of sent and received
+    # frames and flood bases, VLAN numbers, ports outside the default VLAN (port, VLAN), trunk ports (port,
+    # forwarding), MAC table columns (MAC, port, last seen step, VLAN) in last-seen order, frames left in port
+    # buffers (port, destination MAC, number of frames), ports of multicast groups (group MAC, port), flood counters
+    # (VLAN, frames), egress ports of the last flooded frame (or ports excluded from it if it was flooded to the
+    # default VLAN), ports which pulled it and, for the 'oldest' eviction policy, MAC addresses of the table in order
+    # of learning. Like ports, the record only grows with ports which are used; the last flooded frame is saved once
+    # rather than in the buffers of all its egress ports
+
+    _RECORD_HEADER = Struct('<29q')
+
+    def _to_record(self):
+        buffered = array('q')
+        for port, slot in self._slots.items():
+            if self._buffer_epochs[slot] == self._epoch:
+                for dest_mac, frames in self._buffers[slot].items():
+                    buffered.extend((port, dest_mac, frames))
+        port_vlans = array('q')
+        for port, vlan in self._port_vlan.items():
+            port_vlans.extend((port, vlan))
+        trunks = array('q')
+        for port, forwarding in self.trunk_ports.items():
+            trunks.extend((port, forwarding))
+        groups = array('q')
+        for group, ports in self.mcast_groups.items():
+            for port in sorted(ports):
+                groups.extend((group, port))
+        floods = array('q')
+        for vlan, frames in self._flood_counts.items():
+            if vlan != self._TRUNK_FLOODS:
+                floods.extend((vlan, frames))
+        flood_frame = self._flood_frame or (-1, (), 0, 0, 0, 0)
+        flood_ports = flood_frame[1]
+        default_vlan = isinstance(flood_ports, _DefaultVlanPorts)
+        flood_ports = array('q', sorted(flood_ports._excluded if default_vlan else flood_ports))
+        pulled = array('q', sorted(self._flood_pulled))
+        mac_table = self.mac_table
+        # Addresses removed by aging are left in _learned (see _choose_victim) and aren't saved
+        learned = array('q', [mac for mac in self._learned or () if mac in mac_table])
+        columns = (array('q', mac_table), array('q', [entry.port for entry in mac_table.values()]),
+                   array('q', [entry.stamp for entry in mac_table.values()]),
+                   array('q', [entry.vlan for entry in mac_table.values()]))
+        header = self._RECORD_HEADER.pack(self.num_ports, self.aging_time, self._clock, self._epoch, self._revision,
+                                          self._total_sent, self._total_received, len(self.vlan_db),
+                                          len(self.trunk_ports), len(mac_table), len(buffered) // 3,
+                                          self.mac_capacity or 0, self.MAC_EVICTION.index(self.mac_eviction),
+                                          self.mac_evictions, self.learn_failures, len(groups) // 2,
+                                          len(self._slots), len(self._port_vlan), len(floods) // 2,
+                                          self._flood_counts.get(self._TRUNK_FLOODS, 0), flood_frame[0],
+                                          flood_frame[2], flood_frame[3], flood_frame[4], flood_frame[5], default_vlan,
+                                          len(flood_ports), len(pulled), len(learned))
+        parts = [header, array('q', self._slots), self._sent, self._received, self._flood_base,
+                 array('q', self.vlan_db), port_vlans, trunks]
+        parts.extend(columns)
+        parts.extend((buffered, groups, floods, flood_ports, pulled, learned))
+        if byteorder != 'little':
+            for part in parts[1:]:
+                part.byteswap()
+        return b''.join(bytes(part) for part in parts)
+
+    # Restore the switch's state from a binary record (see _to_record); data may be a slice of a memory-mapped file
+
+    def _from_record(self, data):
+        (num_ports, aging_time, clock, epoch, revision, total_sent, total_received,
+         num_vlans, num_trunks, num_macs, num_buffered, mac_capacity, mac_eviction, mac_evictions,
+         learn_failures, num_group_ports, num_slots, num_port_vlans, num_floods, trunk_floods, flood_epoch,
+         flood_ingress, flood_dest, flood_vlan, flood_kind, default_vlan, num_flood_ports, num_pulled,
+         num_learned) = self._RECORD_HEADER.unpack_from(data)
+        offset = self._RECORD_HEADER.size
+
+        def read(typecode, length):
+            nonlocal offset
+            part = array(typecode)
+            part.frombytes(data[offset:offset + 8 * length])
+            if byteorder != 'little':
+                part.byteswap()
+            offset += 8 * length
+            return part
+
+        Switch.__init__(self, 0, aging_time)
+        self.num_ports = num_ports
+        self._slots = {port: slot for slot, port in enumerate(read('q', num_slots))}
+        self._sent = read('Q', num_slots)
+        self._received = read('Q', num_slots)
+        self._flood_base = read('Q', num_slots)
+        self._buffer_epochs = array('q', [-1]) * num_slots
+        self._buffers = [None] * num_slots
+        self.vlan_db = {vlan: set() for vlan in read('q', num_vlans)}
+        port_vlans = read('q', 2 * num_port_vlans)
+        self._port_vlan = dict(zip(port_vlans[::2], port_vlans[1::2]))
+        for port, vlan in self._port_vlan.items():
+            self.vlan_db[vlan].add(port)
+        trunks = read('q', 2 * num_trunks)
+        self.trunk_ports = {port: bool(forwarding) for port, forwarding in zip(trunks[::2], trunks[1::2])}
+        macs, ports, stamps, vlans = (read('q', num_macs) for _ in range(4))
+        self.mac_table = OrderedDict(zip(macs, map(MacEntry, ports, stamps, vlans)))
+        if mac_capacity:
+            self.set_mac_capacity(mac_capacity, self.MAC_EVICTION[mac_eviction])
+        self.mac_evictions = mac_evictions
+        self.learn_failures = learn_failures
+        self._clock = clock
+        self._epoch = epoch
+        self._total_sent = total_sent
+        self._total_received = total_received
+        buffered = read('q', 3 * num_buffered)
+        for port, dest_mac, frames in zip(buffered[::3], buffered[1::3], buffered[2::3]):
+            slot = self._slots[port]
+            if self._buffer_epochs[slot] != epoch:
+                self._buffer_epochs[slot] = epoch
+                self._buffers[slot] = {}
+            self._buffers[slot][dest_mac] = frames
+        groups = read('q', 2 * num_group_ports)
+        for group, port in zip(groups[::2], groups[1::2]):
+            self.mcast_groups.setdefault(group, set()).add(port)
+        floods = read('q', 2 * num_floods)
+        self._flood_counts = dict(zip(floods[::2], floods[1::2]))
+        if trunk_floods:
+            self._flood_counts[self._TRUNK_FLOODS] = trunk_floods
+        self._sampled_floods = dict(self._flood_counts)
+        flood_ports = read('q', num_flood_ports)
+        pulled = read('q', num_pulled)
+        if flood_epoch >= 0:
+            if default_vlan:
+                ports = _DefaultVlanPorts(num_ports, flood_ports)
+            else:
+                ports = frozenset(flood_ports)
+            self._flood_frame = (flood_epoch, ports, flood_ingress, flood_dest, flood_vlan, flood_kind)
+            self._flood_pulled = set(pulled)
+        learned = read('q', num_learned)
+        if self._learned is not None:
+            self._learned = dict.fromkeys(learned)
+        self._revision = revision
+
+    # Check that a record is as long as its header says (see _to_record), so a truncated or damaged snapshot
+    # is found when it's loaded rather than when the switch is first used; raises ValueError saying what's wrong
+
+    def _check_record(self, data):
+        if len(data) < self._RECORD_HEADER.size:
+            raise ValueError("is truncated")
+        (_, _, _, _, _, _, _, num_vlans, num_trunks, num_macs, num_buffered, _, mac_eviction, _, _, num_group_ports,
+         num_slots, num_port_vlans, num_floods, _, _, _, _, _, _, _, num_flood_ports, num_pulled,
+         num_learned) = self._RECORD_HEADER.unpack_from(data)
+        counts = (4 * num_slots, num_vlans, 2 * num_port_vlans, 2 * num_trunks, 4 * num_macs, 3 * num_buffered,
+                  2 * num_group_ports, 2 * num_floods, num_flood_ports, num_pulled, num_learned)
+        if min(counts) < 0 or not 0 <= mac_eviction < len(self.MAC_EVICTION):
+            raise ValueError("is damaged")
+        if len(data) != self._RECORD_HEADER.size + 8 * sum(counts):
+            raise ValueError("is truncated")
+
+    # A switch restored from a snapshot is loaded from its record on first use (see RuntimeEnv.load); this is
+    # only called for attributes which don't exist, so a loaded switch doesn't pay anything for it
+
+    def __getattr__(self, name):
+        record = self.__dict__.pop('_record', None)
+        if record is None:
+            raise AttributeError(name)
+        self._from_record(record)
+        return getattr(self, name)
 
     # This method allows to create a VLAN on a switch
 
     def create_vlan(self, vlan_num):
-        if 'vlan{}'.format(vlan_num) not in self.vlan_db:
-            self.vlan_db['vlan{}'.format(vlan_num)] = set()
+        vlan_num = int(vlan_num)
+        if vlan_num not in self.vlan_db:
+            self.vlan_db[vlan_num] = set()
+            self._topology_changed()
 
     # This method allows to assign ports to a VLAN, provided that the VLAN exists and all port numbers do not
-    # exceed the switch's (num_ports - 1), which is a maximum port number
+    # exceed the switch's (num_ports - 1), which is a maximum port number. Trunk ports are left as they are.
+    # Ports are moved using the port-to-VLAN index, so only the VLANs of the ports being moved are touched
 
     def assign_ports_to_vlan(self, vlan_num, vlan_ports):
-        if 'vlan{}'.format(vlan_num) in self.vlan_db:
-            for port in vlan_ports:
-                if int(port) < self.num_ports:
-                    self.vlan_db['vlan{}'.format(vlan_num)].add('port_{}'.format(port))
-            for vlan in self.vlan_db:
-                if vlan != 'vlan{}'.format(vlan_num):
-                    for port in vlan_ports:
-                        if "port_{}".format(port) in self.vlan_db[vlan]:
-                            self.vlan_db[vlan].remove("port_{}".format(port))
+        vlan_num = int(vlan_num)
+        if vlan_num in self.vlan_db:
+            # All port numbers are parsed before any port is moved, so a bad one leaves the VLANs as they were
+            for port in [int(port) for port in vlan_ports]:
+                if 0 <= port < self.num_ports and port not in self.trunk_ports:
+                    old_vlan = self._vlan_of(port)
+                    if old_vlan != vlan_num:
+                        self._settle_port(port)
+                        self.vlan_db[old_vlan].discard(port)
+                        if vlan_num == 1:
+                            del self._port_vlan[port]
+                        else:
+                            self.vlan_db[vlan_num].add(port)
+                            self._port_vlan[port] = vlan_num
+                        self._rebase_port(port)
+            self._topology_changed()
 
 
 # This is a class for workstation object. Acts as a client on a LAN
 class Station(NetDevice):
 
-    # Creating a workstation with one LAN port, MAC address and connecting it to a switch_port on the switch
+    # Creating a workstation with one LAN port, MAC address and connecting it to a switch_port on the switch;
+    # MAC address is given either as a 'xxxx.xxxx.xxxx' string or as an integer
 
     def __init__(self, mac, switch, switch_port):
         self._switch = switch
         self.switch_port = int(switch_port)
-        self.mac = mac
+        self.mac = parse_mac(mac) if isinstance(mac, str) else mac
+        if is_group_mac(self.mac):
+            raise ValueError("{} is a group address, a workstation can't have it".format(format_mac(self.mac)))
+        self.groups = {BROADCAST_MAC}    # group addresses the workstation accepts frames for, see Fabric.join
         super().__init__(1)
 
+    # Restore a workstation saved to a snapshot on an instance made with Station.__new__ (see RuntimeEnv.load).
+    # Only what's needed to find the workstation is set; its per-port state is created from counters of sent
+    # and received frames on first use (see __getattr__), so restoring many workstations takes little time
+
+    def _restore(self, mac, switch, switch_port, counters):
+        self._switch = switch
+        self.switch_port = switch_port
+        self.mac = mac
+        self.groups = {BROADCAST_MAC}
+        self._counters = counters
+
+    def __getattr__(self, name):
+        counters = self.__dict__.pop('_counters', None)
+        if counters is None:
+            raise AttributeError(name)
+        NetDevice.__init__(self, 1)
+        self._sent[self._slot(0)] = self._total_sent = counters[0]
+        self._received[self._slot(0)] = self._total_received = counters[1]
+        return getattr(self, name)
+
+    # Frames sent and received by the workstation, without creating the state of a restored workstation
+
+    def _totals(self):
+        counters = self.__dict__.get('_counters')
+        if counters is None:
+            return self._total_sent, self._total_received
+        return counters
+
     # Sending message to switch
 
     def send_msg(self, dest_mac):
         self._switch.send_frame(self.mac, dest_mac, self.switch_port)
         self.send(0)
 
-    # Receiving message from the corresponding switch port
+    # Receiving message from the corresponding switch port: frames for a destination given, or frames for
+    # the workstation's own MAC address and all its groups
+
+    def receive_msg(self, dest_mac=None):
+        if dest_mac is None:
+            frames = self._switch.pull_frames(self.switch_port, self.mac)
+            for group in self.groups:
+                frames += self._switch.pull_frames(self.switch_port, group)
+        else:
+            frames = self._switch.pull_frames(self.switch_port, dest_mac)
+        if frames:
+            self.receive(0, frames)
+
+
+# Fabric connects switches with trunk links and moves frames between them. Frames travel as events of a
+# discrete-event scheduler: a heap ordered by (time, sequence number), where time is a logical time and every
+# trunk link has its own delay. To prevent flooded frames from looping between switches, a link which would
+# close a loop is blocked when it's connected, so forwarding links always form a spanning tree of the switches
+class Fabric:
+
+    def __init__(self):
+        self.now = 0
+        self._events = []
+        self._seq = 0
+        self._links = {}       # (switch, port) -> (peer switch, peer port, link delay, True if the link is forwarding)
+        self._parents = {}     # union-find forest of connected switches, used to detect loops
+        self._ports = set()    # (switch, port) used by workstations
+        self._stations = {}    # (switch, MAC) -> workstations with the MAC connected to the switch
+
+    # Find a root of a switch's tree in the union-find forest
+
+    def _find(self, switch):
+        parents = self._parents
+        parents.setdefault(switch, switch)
+        while parents[switch] is not switch:
+            parents[switch] = parents[parents[switch]]
+            switch = parents[switch]
+        return switch
+
+    # Connect two switch ports with a trunk link; returns False if the link closes a loop and is blocked
+
+    def connect(self, switch_a, port_a, switch_b, port_b, delay=1):
+        port_a, port_b = int(port_a), int(port_b)
+        if delay < 0:
+            raise ValueError("Link delay can't be negative")
+        for switch, port in ((switch_a, port_a), (switch_b, port_b)):
+            if not 0 <= port < switch.num_ports:
+                raise ValueError("Switch doesn't have port {}".format(port))
+            if (switch, port) in self._links or (switch, port) in self._ports:
+                raise ValueError("Port {} is already used".format(port))
+        forwarding = self._find(switch_a) is not self._find(switch_b)
+        switch_a.set_trunk(port_a, forwarding)
+        switch_b.set_trunk(port_b, forwarding)
+        self._add_link(switch_a, port_a, switch_b, port_b, delay, forwarding)
+        return forwarding
+
+    # Record a link between two trunk ports; forwarding links join trees of the union-find forest
+
+    def _add_link(self, switch_a, port_a, switch_b, port_b, delay, forwarding):
+        if forwarding:
+            self._parents[self._find(switch_b)] = self._find(switch_a)
+        self._links[(switch_a, port_a)] = (switch_b, port_b, delay, forwarding)
+        self._links[(switch_b, port_b)] = (switch_a, port_a, delay, forwarding)
+
+    # Register a workstation, so that it pulls frames delivered to its switch port. Workstations are indexed
+    # by their MAC addresses and the groups they accept: only a workstation whose MAC or group is the destination
+    # of a frame needs to pull it
+
+    def attach(self, station):
+        if (station._switch, station.switch_port) in self._links:
+            raise ValueError("Port {} is used by a trunk link".format(station.switch_port))
+        self._ports.add((station._switch, station.switch_port))
+        for mac in [station.mac] + sorted(station.groups):
+            self._stations.setdefault((station._switch, mac), []).append(station)
+
+    # Register many workstations at once, e.g. ones restored from a snapshot; the same as attach for every one
+
+    def _attach_all(self, stations):
+        ports = [(station._switch, station.switch_port) for station in stations]
+        if not self._links.keys().isdisjoint(ports):
+            raise ValueError("A workstation port is used by a trunk link")
+        self._ports.update(ports)
+        setdefault = self._stations.setdefault
+        for station in stations:
+            switch = station._switch
+            setdefault((switch, station.mac), []).append(station)
+            for group in station.groups:
+                setdefault((switch, group), []).append(station)
+
+    # Make an attached workstation a member of a multicast group: its switch port joins the group
+
+    def join(self, station, group):
+        if not is_group_mac(group):
+            raise ValueError("{} is not a group address".format(format_mac(group)))
+        if group not in station.groups:
+            station.groups.add(group)
+            station._switch.join_group(group, station.switch_port)
+            self._stations.setdefault((station._switch, group), []).append(station)
+
+    # Put a frame on the queue of events
+
+    def _schedule(self, time, switch, source_mac, dest_mac, port_num, vlan):
+        heappush(self._events, (time, self._seq, switch, source_mac, dest_mac, port_num, vlan))
+        self._seq += 1
+
+    # Send a frame from a workstation; the frame enters its switch after a delay given
+
+    def send(self, station, dest_mac, delay=0):
+        station.send(0)
+        self._schedule(self.now + delay, station._switch, station.mac, dest_mac, station.switch_port, None)
+
+    # Process queued events in order of their time, up to a time given if any; returns a number of
+    # processed events. Workstations which may have got a frame are passed to deliver with the frame's destination;
+    # by default they pull the frame from their switch ports (see Station.receive_msg)
+
+    def run(self, until=None, deliver=Station.receive_msg):
+        events = self._events
+        processed = 0
+        while events and (until is None or events[0][0] <= until):
+            time, _, switch, source_mac, dest_mac, port_num, vlan = heappop(events)
+            self.now = time
+            decision = switch.send_frame(source_mac, dest_mac, port_num, vlan)
+            processed += 1
+            if decision == FRAME_FILTERED:
+                continue
+            for station in self._stations.get((switch, dest_mac), ()):
+                deliver(station, dest_mac)
+            vlan = switch._source_vlan(source_mac, port_num, vlan)
+            if decision == FRAME_FLOODED or decision == FRAME_MULTICAST:
+                for port, forwarding in switch.trunk_ports.items():
+                    if forwarding and port != port_num:
+                        self._forward(switch, port, source_mac, dest_mac, vlan)
+            elif decision in switch.trunk_ports:
+                # A frame is never sent back to the switch it came from
+                if decision != port_num:
+                    self._forward(switch, decision, source_mac, dest_mac, vlan)
+        return processed
+
+    # Pass a frame tagged with its VLAN over a trunk link to the peer switch
+
+    def _forward(self, switch, port_num, source_mac, dest_mac, vlan):
+        peer, peer_port, delay, _ = self._links[(switch, port_num)]
+        self._schedule(self.now + delay, peer, source_mac, dest_mac, peer_port, vlan)
+
+
+# Concurrent traffic of many workstations in one asyncio event loop: every sending workstation is a task, and
+# every switch port with a workstation behind it has a bounded egress queue drained by a task of that
+# workstation. Frames move through switches and trunk links with the fabric (see Fabric.run) and are put on
+# egress queues of the workstations which got them. A full queue either makes the sender wait until there's
+# room (backpressure) or drops the frame (tail drop). Tasks only switch at known points and destinations are
+# picked by generators seeded from the engine's seed, so runs with the same seed give the same results
+class StationEngine:
+
+    def __init__(self, fabric, queue_size=64, backpressure=True, seed=0):
+        if queue_size < 1:
+            raise ValueError("Queue size must be at least 1")
+        self.fabric = fabric
+        self.queue_size = queue_size
+        self.backpressure = backpressure
+        self.seed = seed
+        self.delivered = 0
+        self.drops = {}          # (switch, port) -> number of frames dropped at the port's egress queue
+        self.max_depth = 0       # the longest egress queue seen
+        self._queues = {}        # (switch, port) -> egress queue, created when the port gets its first frame
+        self._receivers = []
+
+    # Every workstation of senders sends a number of frames to workstations picked at random from peers
+    # (senders by default), yielding to other workstations after every frame. Returns statistics of the run
+
+    def run(self, senders, frames, peers=None):
+        senders = list(senders)
+        peers = senders if peers is None else list(peers)
+        asyncio.run(self._run(senders, frames, [station.mac for station in peers]))
+        return {
+            'stations': len(senders),
+            'sent': len(senders) * frames,
+            'delivered': self.delivered,
+            'dropped': sum(self.drops.values()),
+            'max_queue_depth': self.max_depth,
+        }
+
+    async def _run(self, senders, frames, peer_macs):
+        self._receivers = []
+        tasks = [asyncio.create_task(self._send(station, frames, peer_macs, Random('{}/{}'.format(self.seed, index))))
+                 for index, station in enumerate(senders)]
+        await asyncio.gather(*tasks)
+        for queue in self._queues.values():
+            await queue.join()
+        for receiver in self._receivers:
+            receiver.cancel()
+        await asyncio.gather(*self._receivers, return_exceptions=True)
+        self._queues = {}
+
+    # A sending workstation
+
+    async def _send(self, station, frames, peer_macs, rnd):
+        fabric = self.fabric
+        arrived = []
+
+        def deliver(receiver, _):
+            arrived.append(receiver)
+
+        for _ in range(frames):
+            dest_mac = peer_macs[rnd.randrange(len(peer_macs))]
+            # Workstations don't send frames to themselves
+            while dest_mac == station.mac and len(peer_macs) > 1:
+                dest_mac = peer_macs[rnd.randrange(len(peer_macs))]
+            fabric.send(station, dest_mac)
+            fabric.run(deliver=deliver)
+            for receiver in arrived:
+                pulled = receiver._switch.pull_frames(receiver.switch_port, dest_mac)
+                if pulled:
+                    await self._enqueue(receiver, pulled)
+            arrived.clear()
+            await asyncio.sleep(0)
+
+    # Put frames on the egress queue of a workstation's switch port
+
+    async def _enqueue(self, station, frames):
+        key = (station._switch, station.switch_port)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = asyncio.Queue(self.queue_size)
+            self._receivers.append(asyncio.create_task(self._receive(station, queue)))
+        if self.backpressure:
+            await queue.put(frames)
+        elif queue.full():
+            self.drops[key] = self.drops.get(key, 0) + frames
+            return
+        else:
+            queue.put_nowait(frames)
+        if queue.qsize() > self.max_depth:
+            self.max_depth = queue.qsize()
+
+    # A receiving workstation draining its egress queue, one entry per turn of the event loop
+
+    async def _receive(self, station, queue):
+        while True:
+            frames = await queue.get()
+            station.receive(0, frames)
+            self.delivered += frames
+            queue.task_done()
+            await asyncio.sleep(0)
+
+
+# Pools of worker processes by number of workers. A pool is started once and reused by all parallel batches,
+# since starting worker processes takes longer than processing a small batch
+
+_worker_pools = {}
+
+
+def _worker_pool(workers):
+    pool = _worker_pools.get(workers)
+    if pool is None:
+        pool = _worker_pools[workers] = ProcessPoolExecutor(workers)
+    return pool
+
+
+# Process a part of a switch's traffic in a worker process (see Switch.send_frames_parallel); returns forwarding
+# decisions, counters of the ports which were used, the shard's MAC table and performance statistics if collected
+
+def _run_shard(shard, clock, indices, source_macs, dest_macs, port_nums):
+    decisions = shard.send_frames(source_macs, dest_macs, port_nums, map((clock + 1).__add__, indices))
+    shard._settle_floods()
+    sent = {port: shard._sent[slot] for port, slot in shard._slots.items()}
+    received = {port: shard._received[slot] for port, slot in shard._slots.items()}
+    return (decisions, sent, received, list(shard.mac_table.items()), shard.perf, shard._flood_counts,
+            shard._total_sent)
+
+
+# Read a trace of frames from a file: CSV rows 'source MAC,destination MAC,ingress port' (the first row may be
+# a header) or JSON lines {"src_mac": ..., "dst_mac": ..., "port": ...}. Frames are yielded one by one as the file
+# is read, so a trace of any size takes the same memory. Blank lines are skipped; a malformed row raises
+# ValueError with its line number
+
+def read_trace(path):
+    with open(path, newline='') as trace:
+        if path.endswith('.jsonl'):
+            for line_num, line in enumerate(trace, start=1):
+                if line.strip():
+                    try:
+                        frame = json.loads(line)
+                        yield parse_mac(frame['src_mac']), parse_mac(frame['dst_mac']), int(frame['port'])
+                    except (AttributeError, KeyError, TypeError, ValueError) as error:
+                        raise ValueError("{}:{}: malformed frame ({!s})".format(path, line_num, error))
+        else:
+            reader = csv.reader(trace)
+            for row in reader:
+                if not row:
+                    continue
+                if reader.line_num == 1 and len(row) >= 3 and not row[2].strip().isdigit():
+                    continue    # header row
+                if len(row) < 3:
+                    raise ValueError("{}:{}: malformed row, expected 'source MAC,destination MAC,ingress port'"
+                                     .format(path, reader.line_num))
+                try:
+                    yield parse_mac(row[0]), parse_mac(row[1]), int(row[2])
+                except ValueError as error:
+                    raise ValueError("{}:{}: malformed row ({})".format(path, reader.line_num, error))
+
+
+# A stream of per-port statistics of switches written to a CSV or JSON lines file. Every sample only has rows
+# for ports whose counters changed since the previous sample (see NetDevice._take_changed_ports), with current
+# counters and their change since the port's previous row (the first row of a port counts from zero), so a sample
+# takes time proportional to the traffic since the previous one rather than to the number of ports. Samples are
+# taken at most every interval seconds (see poll), and rows are kept in memory until buffer_rows of them are
+# collected
+class StatsStream:
+
+    FIELDS = ('time', 'sample', 'switch', 'port', 'sent', 'received', 'sent_delta', 'received_delta')
+
+    def __init__(self, path, interval=1.0, buffer_rows=10000):
+        if interval < 0:
+            raise ValueError("Interval can't be negative")
+        self.path = path
+        self.interval = interval
+        self.buffer_rows = max(int(buffer_rows), 1)
+        self.samples = 0
+        self.rows_written = 0
+        self._jsonl = path.endswith('.jsonl')
+        self._file = open(path, 'w', newline='')
+        self._csv = None if self._jsonl else csv.writer(self._file)
+        if self._csv is not None:
+            self._csv.writerow(self.FIELDS)
+        self._rows = []
+        self._last = {}            # (switch name, port) -> (sent, received) in the last row of the port
+        self._last_sample = time()   # time of the last sample
+
+    # Forget changes made before the stream started; switches maps names to [switch, used ports]
+
+    def begin(self, switches):
+        for switch, _ in switches.values():
+            if '_record' not in switch.__dict__:
+                switch._take_changed_ports()
+        self._last_sample = time()
+
+    # Take a sample if interval seconds passed since the last one
+
+    def poll(self, switches):
+        if time() - self._last_sample >= self.interval:
+            self.sample(switches)
+
+    def sample(self, switches):
+        now = time()
+        self._last_sample = now
+        self.samples += 1
+        last = self._last
+        rows = self._rows
+        for sw_name, (switch, _) in switches.items():
+            # A switch restored from a snapshot and not used since hasn't changed, and isn't loaded for nothing
+            if '_record' in switch.__dict__:
+                continue
+            for port in sorted(switch._take_changed_ports()):
+                sent, received = switch.get_sent_for_port(port), switch.get_received_for_port(port)
+                last_sent, last_received = last.get((sw_name, port), (0, 0))
+                if sent != last_sent or received != last_received:
+                    last[(sw_name, port)] = (sent, received)
+                    rows.append((now, self.samples, sw_name, port, sent, received, sent - last_sent,
+                                 received - last_received))
+        if len(rows) >= self.buffer_rows:
+            self.flush()
+
+    # Write buffered rows to the file
+
+    def flush(self):
+        if self._jsonl:
+            self._file.writelines(json.dumps(dict(zip(self.FIELDS, row))) + '\n' for row in self._rows)
+        else:
+            self._csv.writerows(self._rows)
+        self.rows_written += len(self._rows)
+        self._rows = []
+        self._file.flush()
+
+    # Counters of a new simulation (e.g. a loaded snapshot) aren't compared with the old ones
+
+    def reset(self):
+        self._last = {}
+
+    # Take the last sample and close the file
 
-    def receive_msg(self):
-        for mac in self._switch.ports['port_{}'.format(self.switch_port)]['sent_frames']['buffer']:
-            if mac == self.mac:
-                self._switch.ports['port_{}'.format(self.switch_port)]['sent_frames']['buffer'].remove(mac)
-                self.receive(0)
+    def close(self, switches):
+        self.sample(switches)
+        self.flush()
+        self._file.close()
+
+
+# Registry of all devices of the simulation: switches and workstations by name, plus indexes of workstations by
+# MAC address and by switch, so that lookups and checks for duplicates don't scan all devices
+class DeviceRegistry:
+
+    def __init__(self):
+        self.switches = {}      # switch name -> [switch, set of used ports]
+        self.pcs = {}           # PC name -> [workstation, switch name]
+        self._macs = {}         # MAC -> name of the PC with the MAC
+        self._switch_pcs = {}   # switch name -> names of PCs connected to the switch, in order of creation
+
+    def __contains__(self, name):
+        return name in self.switches or name in self.pcs
+
+    def add_switch(self, name, switch, used_ports=()):
+        if name in self:
+            raise ValueError("Name {} is already used".format(name))
+        self.switches[name] = [switch, set(used_ports)]
+        self._switch_pcs[name] = {}
+
+    # Add a workstation connected to a port of a registered switch; the name, MAC address and switch port must
+    # be unused. The workstation isn't attached to the fabric here
+
+    def add_pc(self, name, station, sw_name):
+        if name in self:
+            raise ValueError("Name {} is already used".format(name))
+        if sw_name not in self.switches:
+            raise ValueError("Switch {} doesn't exist".format(sw_name))
+        switch, used_ports = self.switches[sw_name]
+        if not 0 <= station.switch_port < switch.num_ports or station.switch_port in used_ports:
+            raise ValueError("Switch {} doesn't have port {} or the port is used".format(sw_name, station.switch_port))
+        if station.mac in self._macs:
+            raise ValueError("MAC address {} is used by {}".format(format_mac(station.mac), self._macs[station.mac]))
+        used_ports.add(station.switch_port)
+        self._index_pc(name, station, sw_name)
+
+    # Add a workstation to the indexes without any checks, e.g. one restored from a snapshot, whose switch
+    # isn't loaded yet (see RuntimeEnv.load)
+
+    def _index_pc(self, name, station, sw_name):
+        self.pcs[name] = [station, sw_name]
+        self._macs[station.mac] = name
+        self._switch_pcs[sw_name][name] = None
+
+    # Bulk version of _index_pc for lists of names, workstations and switch names
+
+    def _index_pcs(self, names, stations, sw_names):
+        self.pcs.update(zip(names, map(list, zip(stations, sw_names))))
+        self._macs.update(zip([station.mac for station in stations], names))
+        switch_pcs = self._switch_pcs
+        for name, sw_name in zip(names, sw_names):
+            switch_pcs[sw_name][name] = None
+
+    # Name of the PC with a MAC address, or None
+
+    def pc_by_mac(self, mac):
+        return self._macs.get(mac)
+
+    # Names of PCs connected to a switch
+
+    def switch_pcs(self, sw_name):
+        return list(self._switch_pcs.get(sw_name, ()))
 
 
 # This is a main user environment
 class RuntimeEnv:
 
     def __init__(self):
-        self.network_objects = {'pc': {},
-                                'switch': {}
+        self.registry = DeviceRegistry()
+        # Devices by kind: switch name -> [switch, used ports], PC name -> [workstation, switch name]; the dicts
+        # belong to the registry, devices are added with its add_switch and add_pc
+        self.network_objects = {'pc': self.registry.pcs,
+                                'switch': self.registry.switches
                                 }
-
-    # Command line interface
-
-    def shell(self):
+        self.fabric = Fabric()    # trunk links between switches, frames are sent through it
+        self._args = deque()
+        self._batch = False
+        self._answered_inline = False   # whether the last answer was an inline argument, see _reject
+        self._snapshot_records = {}    # switch name -> where the switch's record is in the last snapshot
+        self.stats_stream = None       # StatsStream of per-port statistics, if it's started (see 'stats' command)
+
+    # Number of words a command consists of; words after them are inline arguments
+    _INLINE_ARGS = {'create': 2, 'switch': 2, 'send': 1}
+
+    # Start an empty simulation; a running statistics stream goes on with the new one
+
+    def _clear(self):
+        stream = self.stats_stream
+        self.__init__()
+        if stream is not None:
+            stream.reset()
+            self.stats_stream = stream
+
+    # Get an answer for a command's question: an inline argument if there is one left, otherwise ask the user.
+    # Scripts have no one to ask, so a missing argument is an error
+
+    def _prompt(self, question):
+        if self._args:
+            self._answered_inline = True
+            return self._args.popleft()
+        if self._batch:
+            raise ValueError("Missing argument: {}".format(question))
+        self._answered_inline = False
+        return input(question)
+
+    # An answer failed a check: a user who typed it in is asked again, while an inline answer gives up the command
+    # (the next inline argument isn't an answer to the same question)
+
+    def _reject(self, message):
+        if self._answered_inline:
+            raise ValueError(message)
+        print("Invalid input: {}".format(message))
+
+    # Send frames of a trace file through a switch, in batches of chunk_size frames; returns a number of frames sent.
+    # A bad frame stops the replay; the error tells how many frames (whole batches) were sent before it
+
+    def replay_trace(self, switch_name, path, chunk_size=10000):
+        switch = self.network_objects['switch'][switch_name][0]
+        frames = read_trace(path)
+        replayed = 0
+        while True:
+            try:
+                chunk = list(islice(frames, chunk_size))
+                if not chunk:
+                    return replayed
+                source_macs, dest_macs, port_nums = zip(*chunk)
+                switch.send_frames(source_macs, dest_macs, port_nums)
+            except (IndexError, ValueError) as error:
+                raise type(error)("{}; {} frames were replayed".format(error, replayed))
+            replayed += len(chunk)
+            if self.stats_stream is not None:
+                self.stats_stream.poll(self.network_objects['switch'])
+
+    # Save the whole simulation to a snapshot file. The file starts with _SNAPSHOT_HEADER (magic and offset of
+    # the index), followed by binary records of switches (see Switch._to_record), columns of workstations and
+    # the index: JSON with locations of switch records, names of workstations, trunk links and frames in flight.
+    # Workstations are saved as flat little-endian arrays: MAC addresses, switch numbers (in order of switches
+    # in the index), switch ports, counters of sent and received frames, then groups (workstation number,
+    # group MAC) other than broadcast. An incremental snapshot only writes records of switches which changed
+    # since the last snapshot, and refers to the files of earlier snapshots for the others, so those files must
+    # be kept. Returns a number of switch records written
+
+    _SNAPSHOT_MAGIC = b'SWSIMSN6'
+    _SNAPSHOT_HEADER = Struct('<8sQ')
+
+    def save(self, path, incremental=False):
+        path = os_path.abspath(path)
+        previous = self._snapshot_records if incremental else {}
+        if any(record[0] == path for record in previous.values()):
+            raise ValueError("An incremental snapshot can't overwrite a snapshot it refers to")
+        records = {}
+        index = {'switches': {}, 'pcs': {}, 'links': [], 'fabric': {}}
+        names = {}
+        written = 0
+        # The snapshot is written to a new file which replaces the old one, as records of switches which weren't
+        # used yet may still be read from a file being overwritten
+        directory, name = os_path.split(path)
+        descriptor, temp_path = mkstemp(prefix='.{}.'.format(name), dir=directory)
+        try:
+            with open(descriptor, 'wb') as snapshot:
+                snapshot.write(self._SNAPSHOT_HEADER.pack(self._SNAPSHOT_MAGIC, 0))
+                for sw_name, (switch, used_ports) in self.network_objects['switch'].items():
+                    names[switch] = sw_name
+                    record = previous.get(sw_name)
+                    # A switch which hasn't been used since it was loaded still has its record to load from
+                    if record is None or ('_record' not in switch.__dict__
+                                          and record[3] != [switch._epoch, switch._revision]):
+                        data = switch._to_record()
+                        record = [path, snapshot.tell(), len(data), [switch._epoch, switch._revision]]
+                        snapshot.write(data)
+                        written += 1
+                    records[sw_name] = record
+                    index['switches'][sw_name] = ([None if record[0] == path else record[0]] + record[1:]
+                                                  + [sorted(used_ports)])
+                switch_numbers = {sw_name: number for number, sw_name in enumerate(index['switches'])}
+                macs, pc_switches, pc_ports, pc_sent, pc_received, groups = (array('q') for _ in range(6))
+                for number, (station, sw_name) in enumerate(self.network_objects['pc'].values()):
+                    sent, received = station._totals()
+                    macs.append(station.mac)
+                    pc_switches.append(switch_numbers[sw_name])
+                    pc_ports.append(station.switch_port)
+                    pc_sent.append(sent)
+                    pc_received.append(received)
+                    for group in sorted(station.groups):
+                        if group != BROADCAST_MAC:
+                            groups.extend((number, group))
+                index['pcs'] = {'names': list(self.network_objects['pc']), 'offset': snapshot.tell(),
+                                'groups': len(groups) // 2}
+                for part in (macs, pc_switches, pc_ports, pc_sent, pc_received, groups):
+                    if byteorder != 'little':
+                        part.byteswap()
+                    snapshot.write(bytes(part))
+                fabric = self.fabric
+                for (switch, port_num), (peer, peer_port, delay, forwarding) in fabric._links.items():
+                    if (names[switch], port_num) < (names[peer], peer_port):
+                        index['links'].append([names[switch], port_num, names[peer], peer_port, delay, forwarding])
+                index['fabric'] = {'now': fabric.now, 'seq': fabric._seq,
+                                   'events': [[time, seq, names[switch], source_mac, dest_mac, port_num, vlan]
+                                              for time, seq, switch, source_mac, dest_mac, port_num, vlan
+                                              in fabric._events]}
+                index_offset = snapshot.tell()
+                snapshot.write(json.dumps(index).encode())
+                snapshot.seek(0)
+                snapshot.write(self._SNAPSHOT_HEADER.pack(self._SNAPSHOT_MAGIC, index_offset))
+            # mkstemp makes the file private; give it the permissions of the file it replaces, or of a new file
+            try:
+                mode = S_IMODE(os_stat(path).st_mode)
+            except FileNotFoundError:
+                mask = umask(0)
+                umask(mask)
+                mode = 0o666 & ~mask
+            chmod(temp_path, mode)
+            replace(temp_path, path)
+        except BaseException:
+            remove(temp_path)
+            raise
+        self._snapshot_records = records
+        return written
+
+    # Replace the whole simulation with one saved to a snapshot file. Snapshot files are memory-mapped and switches
+    # are created empty: a switch is loaded from its record when it's used for the first time, so loading takes
+    # the same time whatever the size of the switches: only the header of every record is read to check its length
+
+    def load(self, path):
+        path = os_path.abspath(path)
+        files = {}
+
+        def map_file(file_path):
+            if file_path not in files:
+                if os_path.getsize(file_path) < self._SNAPSHOT_HEADER.size:
+                    raise ValueError("{} is not a snapshot file".format(file_path))
+                with open(file_path, 'rb') as snapshot:
+                    data = memoryview(mmap(snapshot.fileno(), 0, access=ACCESS_READ))
+                if data[:8] != self._SNAPSHOT_MAGIC:
+                    raise ValueError("{} is not a snapshot file".format(file_path))
+                files[file_path] = data
+            return files[file_path]
+
+        data = map_file(path)
+        _, index_offset = self._SNAPSHOT_HEADER.unpack_from(data)
+        if not self._SNAPSHOT_HEADER.size <= index_offset < len(data):
+            raise ValueError("{} is not a snapshot file".format(path))
+        # Switches and their records are checked before the current simulation is replaced
+        loaded = {}
+        try:
+            index = json.loads(bytes(data[index_offset:]))
+            for sw_name, (file_path, offset, length, signature, used_ports) in index['switches'].items():
+                file_path = file_path or path
+                file_data = map_file(file_path)
+                if not 0 <= offset <= len(file_data) - length:
+                    raise ValueError("Record of switch {} is outside {}".format(sw_name, file_path))
+                switch = Switch.__new__(Switch)
+                record = file_data[offset:offset + length]
+                try:
+                    switch._check_record(record)
+                except ValueError as error:
+                    raise ValueError("Record of switch {} in {} {}".format(sw_name, file_path, error))
+                switch._record = record
+                loaded[sw_name] = (switch, used_ports, [file_path, offset, length, signature])
+            pc_names, pc_offset, num_groups = index['pcs']['names'], index['pcs']['offset'], index['pcs']['groups']
+            num_pcs = len(pc_names)
+            if not self._SNAPSHOT_HEADER.size <= pc_offset <= index_offset - 8 * (5 * num_pcs + 2 * num_groups):
+                raise ValueError("{} is not a snapshot file, its workstations are outside it".format(path))
+
+            def read(length):
+                nonlocal pc_offset
+                part = array('q')
+                part.frombytes(data[pc_offset:pc_offset + 8 * length])
+                if byteorder != 'little':
+                    part.byteswap()
+                pc_offset += 8 * length
+                return part
+
+            macs, pc_switches, pc_ports, pc_sent, pc_received = (read(num_pcs) for _ in range(5))
+            groups = read(2 * num_groups)
+            if num_pcs and not 0 <= min(pc_switches) <= max(pc_switches) < len(loaded):
+                raise ValueError("{} is not a snapshot file, its workstations are damaged".format(path))
+        except (AttributeError, KeyError, TypeError) as error:
+            raise ValueError("{} is not a snapshot file, its index is damaged ({!r})".format(path, error))
+        self._clear()
+        for sw_name, (switch, used_ports, record) in loaded.items():
+            self.registry.add_switch(sw_name, switch, used_ports)
+            self._snapshot_records[sw_name] = record
+        switches = {sw_name: switch for sw_name, (switch, _, _) in loaded.items()}
+        for sw_name, port_num, peer_name, peer_port, delay, forwarding in index['links']:
+            self.fabric._add_link(switches[sw_name], port_num, switches[peer_name], peer_port, delay, forwarding)
+        # Workstations are restored and indexed in bulk, see Station._restore. They all live as long as the
+        # simulation, so the garbage collector is paused rather than scanning them again and again as they're made
+        sw_names = list(loaded)
+        switch_list = [switches[sw_name] for sw_name in sw_names]
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            new_station = Station.__new__
+            stations = []
+            for mac, number, port_num, sent, received in zip(macs, pc_switches, pc_ports, pc_sent, pc_received):
+                station = new_station(Station)
+                station._restore(mac, switch_list[number], port_num, (sent, received))
+                stations.append(station)
+            for number, group in zip(groups[::2], groups[1::2]):
+                stations[number].groups.add(group)
+            self.registry._index_pcs(pc_names, stations, [sw_names[number] for number in pc_switches])
+            self.fabric._attach_all(stations)
+        finally:
+            if collecting:
+                gc.enable()
+        self.fabric.now = index['fabric']['now']
+        self.fabric._seq = index['fabric']['seq']
+        self.fabric._events = [(time, seq, switches[sw_name], source_mac, dest_mac, port_num, vlan)
+                               for time, seq, sw_name, source_mac, dest_mac, port_num, vlan in index['fabric']['events']]
+
+    # Replace the simulation with a network described by a JSON topology file:
+    #   {"switches": [{"name": "SW_1", "ports": 48, "aging_time": 5, "mac_capacity": 1000, "eviction": "lru",
+    #                  "vlans": {"100": [0, 1, 2]}}, ...],
+    #    "trunks": [{"from": "SW_1", "from_port": 47, "to": "SW_2", "to_port": 47, "delay": 1}, ...],
+    #    "pcs": [{"name": "PC_1", "switch": "SW_1", "mac": "0000.0000.0001", "port": 3,
+    #             "groups": ["0100.5e00.0001"]}, ...]}
+    # Only names, ports and MAC addresses are required. Devices are checked and built in one pass; duplicate names,
+    # MAC addresses and ports are found with the registry's indexes. The simulation is replaced only if the whole
+    # topology is valid. Returns numbers of switches, trunk links and PCs
+
+    def load_topology(self, path):
+        with open(path) as topology_file:
+            topology = json.load(topology_file)
+        if not isinstance(topology, dict):
+            raise ValueError("Topology must be a JSON object")
+        registry = DeviceRegistry()
+        fabric = Fabric()
+
+        def build(section, make):
+            items = topology.get(section, [])
+            if not isinstance(items, list):
+                raise ValueError("'{}' must be a list".format(section))
+            for position, item in enumerate(items):
+                try:
+                    if not isinstance(item, dict):
+                        raise ValueError("must be an object")
+                    make(item)
+                except KeyError as error:
+                    raise ValueError("{}[{}]: missing {}".format(section, position, error))
+                except (IndexError, TypeError, ValueError) as error:
+                    raise ValueError("{}[{}]: {}".format(section, position, error))
+            return len(items)
+
+        # JSON values which must be of a type: names and MAC addresses are strings, lists of ports and groups are
+        # lists and VLANs are an object
+
+        kinds = {str: 'a string', list: 'a list', dict: 'an object'}
+
+        def checked(value, kind, what):
+            if not isinstance(value, kind):
+                raise ValueError("{} must be {}".format(what, kinds[kind]))
+            return value
+
+        def make_switch(item):
+            switch = Switch(int(item['ports']), int(item.get('aging_time', 5)), item.get('mac_capacity'),
+                            item.get('eviction', 'lru'))
+            registry.add_switch(checked(item['name'], str, "'name'"), switch)
+            for vlan, ports in checked(item.get('vlans', {}), dict, "'vlans'").items():
+                ports = [int(port) for port in checked(ports, list, "Ports of VLAN {}".format(vlan))]
+                for port in ports:
+                    if not 0 <= port < switch.num_ports:
+                        raise ValueError("Switch doesn't have port {}".format(port))
+                switch.create_vlan(vlan)
+                switch.assign_ports_to_vlan(vlan, ports)
+
+        def make_trunk(item):
+            ends = []
+            for side in ('from', 'to'):
+                sw_name, port_num = checked(item[side], str, "'{}'".format(side)), int(item[side + '_port'])
+                if sw_name not in registry.switches:
+                    raise ValueError("Switch {} doesn't exist".format(sw_name))
+                if port_num in registry.switches[sw_name][1]:
+                    raise ValueError("Port {} of {} is used".format(port_num, sw_name))
+                ends.append((registry.switches[sw_name], port_num))
+            (switch_a, used_a), port_a = ends[0]
+            (switch_b, used_b), port_b = ends[1]
+            fabric.connect(switch_a, port_a, switch_b, port_b, int(item.get('delay', 1)))
+            used_a.add(port_a)
+            used_b.add(port_b)
+
+        def make_pc(item):
+            sw_name = checked(item['switch'], str, "'switch'")
+            if sw_name not in registry.switches:
+                raise ValueError("Switch {} doesn't exist".format(sw_name))
+            station = Station(parse_mac(checked(item['mac'], str, "'mac'")), registry.switches[sw_name][0],
+                              int(item['port']))
+            registry.add_pc(checked(item['name'], str, "'name'"), station, sw_name)
+            fabric.attach(station)
+            for group in checked(item.get('groups', []), list, "'groups'"):
+                fabric.join(station, parse_mac(checked(group, str, "Group {!r}".format(group))))
+
+        counts = (build('switches', make_switch), build('trunks', make_trunk), build('pcs', make_pc))
+        self._clear()
+        self.registry = registry
+        self.network_objects = {'pc': registry.pcs, 'switch': registry.switches}
+        self.fabric = fabric
+        return counts
+
+    # Send traffic through several switches at once using a pool of worker processes. traffic maps switch names
+    # to lists of frames (source MAC, destination MAC, ingress port); frames don't cross trunk links here, so
+    # switches are independent, and traffic of every switch is split further by VLAN domains
+    # (see Switch.send_frames_parallel). Returns forwarding decisions per switch name
+
+    def run_parallel(self, traffic, workers=None):
+        workers = workers or cpu_count() or 1
+        plans = {}
+        decisions = {sw_name: [] for sw_name in traffic}
+        for sw_name, frames in traffic.items():
+            if frames:
+                columns = tuple(list(column) for column in zip(*frames))
+                switch = self.network_objects['switch'][sw_name][0]
+                if switch.mac_capacity is not None:
+                    # A bounded MAC table can't be split (see Switch.send_frames_parallel)
+                    decisions[sw_name] = switch.send_frames(*columns)
+                    continue
+                plans[sw_name] = (columns, switch._plan_shards(*columns, switch._split_domains(*columns, workers)))
+        shards = [shard for _, plan in plans.values() for _, _, shard in plan]
+        if len(shards) > 1:
+            results = list(_worker_pool(workers).map(_run_shard, *zip(*shards)))
+        else:
+            results = [_run_shard(*shard) for shard in shards]
+        for sw_name, (columns, plan) in plans.items():
+            switch = self.network_objects['switch'][sw_name][0]
+            decisions[sw_name] = switch._merge_shards(*columns, plan, results[:len(plan)])
+            results = results[len(plan):]
+        return decisions
+
+    # Command line interface; if a script (an iterable of command lines) is given, commands are read from it
+    # instead of the user's input and all arguments must be given inline. Quiet mode doesn't print every frame sent
+
+    def shell(self, script=None, quiet=False):
+        lines = iter(script) if script is not None else None
         while True:
-            command = input('> ')
+            if lines is None:
+                command = input('> ')
+            else:
+                command = next(lines, 'quit')
             # Split command string into parts
             com_stack = command.split()
-
-            # Help command
-            if com_stack[0] == 'help':
-                print('=' * 10)
-                print("This is my attempt to create a simple simulation\n"
-                      "of the most basic operations of a network switch.\n"
-                      "Yes, I realize that this is not a fully-functional network\n"
-                      "simulator. For now, it supports a single switch and a few PCs\n"
-                      "connected to it.")
-                print('=' * 10)
-                print("Below is a list of all supported commands. All commands will prompt you for some input.\n"
-                      "It should be quite clear.")
-                print('-' * 10)
-                print("'create switch' - this is where you start; this command will create a switch object for you.\n"
-                      "Everything else is dependant on it\n")
-                print("'create pc' - this command will create a workstation, which will be connected to your switch.\n"
-                      "You have to manually specify MAC addresses\n")
-                print("'show network' - briefly displays general statistics of your switch\n")
-                print("'show switch <switch_name>' - displays more details about a state of your switch, e.g.\n"
-                      "VLANs, ports, number of received frames, number of sent frames, etc.\n")
-                print("'show pc <pc_name>' - similar command for your workstations\n")
-                print("'switch vlan' - creates a vlan on your switch; optionally, allows you to assign ports to\n"
-                      "the new VLAN\n")
-                print("'switch assign' - assigns ports to an existing VLAN\n")
-                print("'send' - allows you to manually send a frame from one workstation to another.\n"
-                      "Then you can check reactions of all network devices using 'show' commands\n")
-                print("'quit' - the meaning is obvious, isn't it?\n\n")
+            # Skip empty lines and comments
+            if not com_stack or com_stack[0].startswith('#'):
                 continue
+            # Sample statistics of the previous command, if the interval has passed
+            if self.stats_stream is not None:
+                self.stats_stream.poll(self.network_objects['switch'])
+            # Arguments given inline, e.g. 'create switch SW_1 10' or 'send PC_1 PC_2 5', answer
+            # the command's questions in order
+            self._args = deque(com_stack[self._INLINE_ARGS.get(com_stack[0], len(com_stack)):])
+            self._batch = lines is not None
+
+            # A command which fails is reported and given up, so one bad line of a script doesn't stop it
+            try:
+                # Help command
+                if com_stack[0] == 'help':
+                    print('=' * 10)
+                    print("This is my attempt to create a simple simulation\n"
+                          "of the most basic operations of a network switch.\n"
+                          "Yes, I realize that this is not a fully-functional network\n"
+                          "simulator. For now, it supports a single switch and a few PCs\n"
+                          "connected to it.")
+                    print('=' * 10)
+                    print("Below is a list of all supported commands. All commands will prompt you for some input.\n"
+                          "It should be quite clear.")
+                    print('-' * 10)
+                    print("'create switch' - this is where you start; this command will create a switch object for you.\n"
+                          "Everything else is dependant on it\n")
+                    print("'create pc' - this command will create a workstation, which will be connected to your switch.\n"
+                          "You have to manually specify MAC addresses\n")
+                    print("'create trunk' - connects ports of two switches with a trunk link carrying frames of all VLANs;\n"
+                          "a link which would create a loop is blocked\n")
+                    print("'show network' - briefly displays general statistics of your switch\n")
+                    print("'show switch <switch_name>' - displays more details about a state of your switch, e.g.\n"
+                          "VLANs, ports, number of received frames, number of sent frames, etc.\n")
+                    print("'show pc <pc_name>' - similar command for your workstations\n")
+                    print("'switch vlan' - creates a vlan on your switch; optionally, allows you to assign ports to\n"
+                          "the new VLAN\n")
+                    print("'switch assign' - assigns ports to an existing VLAN\n")
+                    print("'switch capacity <switch_name> <entries|none> [lru|oldest|refuse]' - limits the MAC table of a switch;\n"
+                          "when it's full, a new address replaces the least recently seen one (lru), the one learned first\n"
+                          "(oldest), or isn't learned at all (refuse), so frames to it are flooded\n")
+                    print("'send' - allows you to manually send a frame from one workstation to another.\n"
+                          "Then you can check reactions of all network devices using 'show' commands. Instead of\n"
+                          "a destination PC, a broadcast (ffff.ffff.ffff) or multicast group address can be given\n")
+                    print("'join <pc_name> <group MAC>' - makes a workstation a member of a multicast group (an address with\n"
+                          "the lowest bit of the first octet set, e.g. 0100.5e00.0001); frames to the group are sent only to\n"
+                          "its members' ports, and frames to a group nobody joined are flooded\n")
+                    print("'traffic <frames> [queue size] [wait|drop] [seed]' - all workstations send frames to each other at\n"
+                          "the same time; switch ports queue at most queue size frames (64 by default) and a full queue\n"
+                          "either makes senders wait or drops frames\n")
+                    print("'replay <switch_name> <trace file>' - sends frames from a CSV or JSONL trace (source MAC,\n"
+                          "destination MAC, ingress port) through a switch\n")
+                    print("'save <file> [incremental]' - saves the whole simulation to a snapshot file; an incremental\n"
+                          "snapshot only saves switches changed since the last snapshot and refers to earlier files\n")
+                    print("'load <file>' - replaces the simulation with one from a snapshot file\n")
+                    print("'topology <file>' - replaces the simulation with a network of switches, VLANs, trunk links and\n"
+                          "PCs described by a JSON file\n")
+                    print("'perf on <switch_name> [sample_every]' / 'perf off <switch_name>' - turns collecting performance\n"
+                          "statistics of a switch on or off; time of forwarding stages is measured for every\n"
+                          "sample_every-th frame (100 by default)\n")
+                    print("'show perf <switch_name>' - displays performance statistics of a switch\n")
+                    print("'perf export <switch_name> <file>' - appends statistics to a JSON lines file, or writes them\n"
+                          "in Prometheus text format if the file name ends with .prom\n")
+                    print("Arguments can also be given inline, in the order they're asked for, e.g.\n"
+                          "'create switch SW_1 10' or 'send PC_1 PC_2 5'\n")
+                    print("'stats start <file> [interval seconds] [buffered rows]' - streams counters of switch ports which\n"
+                          "changed since the previous sample to a CSV (or .jsonl) file; 'stats sample' takes a sample at once,\n"
+                          "'stats stop' closes the file\n")
+                    print("'quit' - the meaning is obvious, isn't it?\n\n")
+                    continue
 
-            # Analysis of 'create' command
-            if com_stack[0] == 'create':
-
-                # User can create either a switch or a workstation (PC)
-                if com_stack[1] == 'switch' or com_stack[1] == 'pc':
-                    while True:
-                        # Giving a unique name to the device
-                        name = input("Provide a name for your new device: ")
-                        # Name must be unique
-                        if (name in self.network_objects['switch']) or (name in self.network_objects['pc']):
-                            print("Names must be unique")
-                            continue
-                        else:
-                            break
-                    # User creates a switch
-                    if com_stack[1] == 'switch':
-                        num_ports = int(input("How many ports (int number): "))
-                        self.network_objects['switch'][name] = [Switch(num_ports), set()]   # Creating a switch object plus a set to store used ports
-                    # Users creates a PC
-                    if com_stack[1] == 'pc':
-                        if len(self.network_objects['switch']) > 0:  # PC cannot be created without at least one switch
-                            switch_name = input("Which switch is it connected to?(switch name): ")
-                            mac_address = input("MAC address for your host (format xxxx.xxxx.xxxx, all hex digits): ")
-                            # Checking if the port number isn't higher than a total number of ports on the switch,
-                            # and the port is not used
-                            while True:
-                                port_num = int(input("Which switch port your host is connected to (int number): "))
-                                if (self.network_objects['switch'][switch_name][0].num_ports >= abs(port_num)) and (port_num not in self.network_objects['switch'][switch_name][1]):
-                                    self.network_objects['pc'][name] = [Station(mac_address, self.network_objects['switch'][switch_name][0], port_num), switch_name]
-                                    self.network_objects['switch'][switch_name][1].add(port_num)
+                # Analysis of 'create' command
+                if com_stack[0] == 'create':
+
+                    # User can create either a switch or a workstation (PC)
+                    if com_stack[1] == 'switch' or com_stack[1] == 'pc':
+                        while True:
+                            # Giving a unique name to the device
+                            name = self._prompt("Provide a name for your new device: ")
+                            # Name must be unique
+                            if (name in self.network_objects['switch']) or (name in self.network_objects['pc']):
+                                self._reject("Names must be unique")
+                                continue
+                            else:
+                                break
+                        # User creates a switch
+                        if com_stack[1] == 'switch':
+                            num_ports = int(self._prompt("How many ports (int number): "))
+                            self.registry.add_switch(name, Switch(num_ports))   # Creating a switch object plus a set to store used ports
+                        # Users creates a PC
+                        if com_stack[1] == 'pc':
+                            if len(self.network_objects['switch']) > 0:  # PC cannot be created without at least one switch
+                                switch_name = self._prompt("Which switch is it connected to?(switch name): ")
+                                if switch_name not in self.network_objects['switch']:
+                                    print("This switch doesn't exist")
+                                    continue
+                                # MAC address is validated and parsed once, here
+                                while True:
+                                    answer = self._prompt("MAC address for your host (format xxxx.xxxx.xxxx, all hex digits): ")
+                                    try:
+                                        mac_address = parse_mac(answer)
+                                    except ValueError as error:
+                                        self._reject(error)
+                                        continue
+                                    if is_group_mac(mac_address):
+                                        self._reject("{} is a group address, a workstation can't have it".format(answer))
+                                        continue
                                     break
-                                else:
-                                    print("Invalid input: switch doesn't have this port or this port is used")
+                                # MAC addresses must be unique
+                                if self.registry.pc_by_mac(mac_address) is not None:
+                                    print("Invalid input: MAC address is used by {}".format(self.registry.pc_by_mac(mac_address)))
                                     continue
+                                # The registry checks that the switch has the port and the port is not used
+                                while True:
+                                    port_num = int(self._prompt("Which switch port your host is connected to (int number): "))
+                                    station = Station(mac_address, self.network_objects['switch'][switch_name][0], port_num)
+                                    try:
+                                        self.registry.add_pc(name, station, switch_name)
+                                    except ValueError as error:
+                                        self._reject(error)
+                                        continue
+                                    self.fabric.attach(station)
+                                    break
+                            else:
+                                print("You have to create at least one switch")
+                                continue
+                    # User connects two switches with a trunk link
+                    elif com_stack[1] == 'trunk':
+                        ends = []
+                        for side in ('first', 'second'):
+                            sw_name = self._prompt("Name of the {} switch: ".format(side))
+                            if sw_name not in self.network_objects['switch']:
+                                print("This switch doesn't exist")
+                                break
+                            port_num = int(self._prompt("Which port of {} is used by the link (int number): ".format(sw_name)))
+                            ends.append((sw_name, port_num))
                         else:
-                            print("You have to create at least one switch")
+                            delay = int(self._prompt("Link delay (int number): "))
+                            (name_a, port_a), (name_b, port_b) = ends
+                            if port_a in self.network_objects['switch'][name_a][1] or port_b in self.network_objects['switch'][name_b][1]:
+                                print("Invalid input: this port is used")
+                                continue
+                            try:
+                                forwarding = self.fabric.connect(self.network_objects['switch'][name_a][0], port_a,
+                                                                 self.network_objects['switch'][name_b][0], port_b, delay)
+                            except ValueError as error:
+                                print("Invalid input: {}".format(error))
+                                continue
+                            self.network_objects['switch'][name_a][1].add(port_a)
+                            self.network_objects['switch'][name_b][1].add(port_b)
+                            if not forwarding:
+                                print("This link creates a loop, it's blocked")
+                    else:
+                        print("Invalid command")
+                        continue
+
+                # Analysis of 'show' command
+                elif com_stack[0] == 'show':
+                    if len(com_stack) < 2:
+                        print("Specify what to display")
+                        continue
+                    # General info about existing switches
+                    if com_stack[1] == 'network':
+                        if len(self.network_objects['switch']) > 0:
+                            print("Switches:")
+                            for sw_name in self.network_objects['switch']:
+                                print("Switch name:{0}, number of ports:{1}, used:{2}".format(sw_name, self.network_objects['switch'][sw_name][0].num_ports,
+                                                                                              self.network_objects['switch'][sw_name][1]))
+                                pcs = ''.join(pc_name + ' ' for pc_name in self.registry.switch_pcs(sw_name))
+                                print('PCs connected: {}'.format(pcs))
+                        else:
+                            print("You haven't created any switches yet")
                             continue
-                else:
-                    print("Invalid command")
-                    continue
+                    # Statistics for a specified switch
+                    elif com_stack[1] == 'switch':
+                        if len(self.network_objects['switch']) == 0:
+                            print("You haven't created any switches yet")
+                            continue
+                        if len(com_stack) < 3:
+                            print("Switch name is missing")
+                            continue
+                        if self.network_objects['switch'][com_stack[2]]:
+                            print("Switch stats:")
+                            print("Name: {}".format(com_stack[2]))
+                            print("Number of ports: {}".format(self.network_objects['switch'][com_stack[2]][0].num_ports))
+                            print("Ports per VLAN")
+                            vlan_stats = self.network_objects['switch'][com_stack[2]][0].vlan_database
+                            for vlan in vlan_stats:
+                                print("VLAN{}".format(vlan))
+                                for port_number in vlan_stats[vlan]:
+                                    print("Port: port_{0}, frames sent:{1}, frames received:{2}".format(port_number, self.network_objects['switch'][com_stack[2]][0].get_sent_for_port(port_number),
+                                                                                                        self.network_objects['switch'][com_stack[2]][0].get_received_for_port(port_number)))
+                            trunk_ports = self.network_objects['switch'][com_stack[2]][0].trunk_ports
+                            if trunk_ports:
+                                print("TRUNKS")
+                                for port_number in sorted(trunk_ports):
+                                    print("Port: port_{0}, {1}, frames sent:{2}, frames received:{3}".format(port_number, 'forwarding' if trunk_ports[port_number] else 'blocked',
+                                                                                                            self.network_objects['switch'][com_stack[2]][0].get_sent_for_port(port_number),
+                                                                                                            self.network_objects['switch'][com_stack[2]][0].get_received_for_port(port_number)))
+                            print("MAC table")
+                            switch = self.network_objects['switch'][com_stack[2]][0]
+                            if switch.mac_capacity is not None:
+                                print("Entries: {0} of {1}, eviction: {2}, evicted: {3}, not learned: {4}".format(
+                                    len(switch.mac_table), switch.mac_capacity, switch.mac_eviction, switch.mac_evictions,
+                                    switch.learn_failures))
+                            print("=" * 10)
+                            for mac in self.network_objects['switch'][com_stack[2]][0].mac_table:
+                                print("Dest. MAC: {0}, dest. port: {1}, VLAN: vlan{2}, age: {3}".format(format_mac(mac), self.network_objects['switch'][com_stack[2]][0].mac_table[mac].port,
+                                                                                                        self.network_objects['switch'][com_stack[2]][0].mac_table[mac].vlan,
+                                                                                                        self.network_objects['switch'][com_stack[2]][0].get_mac_age(mac)))
+                            print("=" * 10)
+                            print("Total sent/received:")
+                            print("Total sent: {0}, total received: {1}".format(self.network_objects['switch'][com_stack[2]][0].total_sent,
+                                                                                self.network_objects['switch'][com_stack[2]][0].total_received))
+                        else:
+                            print("Specify a switch name")
+                            continue
+                    # Show details for a specific PC
+                    elif com_stack[1] == 'pc':
+                        if len(self.network_objects['pc']) == 0:
+                            print("You don't have any workstations")
+                            continue
+                        if len(com_stack) < 3:
+                            print("Specify a PC name for an existing PC")
+                            continue
+                        if self.network_objects['pc'][com_stack[2]]:
+                            print("PC stats:")
+                            print("PC name: {0}, MAC address: {1}".format(com_stack[2], format_mac(self.network_objects['pc'][com_stack[2]][0].mac)))
+                            print("Frames sent: {0}, frames received: {1}".format(self.network_objects['pc'][com_stack[2]][0].get_sent_for_port(0),
+                                                                                  self.network_objects['pc'][com_stack[2]][0].get_received_for_port(0)))
+                        else:
+                            print("PC with this name doesn't exist")
+                            continue
+                    # Performance statistics of a switch
+                    elif com_stack[1] == 'perf':
+                        if len(com_stack) < 3 or com_stack[2] not in self.network_objects['switch']:
+                            print("Specify a switch name")
+                            continue
+                        switch = self.network_objects['switch'][com_stack[2]][0]
+                        if switch.perf is None:
+                            print("Performance statistics are off, use 'perf on {}'".format(com_stack[2]))
+                            continue
+                        report = switch.perf.report(switch)
+                        print("Performance statistics:")
+                        print("Frames: {0}, unicast: {1}, flooded: {2} ({3:.1%}), multicast: {4}, filtered: {5}".format(
+                            report['frames'], report['unicast'], report['floods'], report['flood_ratio'], report['multicast'],
+                            report['filtered']))
+                        print("Flooded copies: {0}, MAC table size: {1}, aged out: {2}".format(
+                            report['flooded_copies'], report['mac_table_size'], report['evictions']))
+                        print("Buffered frames: {0}, max: {1}".format(report['buffer_depth'], report['max_buffer_depth']))
+                        print("Time per stage, sampled every {} frames:".format(report['sample_every']))
+                        for stage in PerfStats.STAGES:
+                            calls = report['stage_calls'][stage]
+                            if calls:
+                                print("{0:<8} calls: {1:<8} total: {2:.6f} s, mean: {3:.3f} us".format(
+                                    stage, calls, report['stage_time'][stage], report['stage_time'][stage] / calls * 1e6))
+                    else:
+                        print("Unrecognized command")
+                        continue
 
-            # Analysis of 'show' command
-            elif com_stack[0] == 'show':
-                if len(com_stack) < 2:
-                    print("Specify what to display")
-                    continue
-                # General info about existing switches
-                if com_stack[1] == 'network':
-                    if len(self.network_objects['switch']) > 0:
-                        print("Switches:")
-                        for sw_name in self.network_objects['switch']:
-                            print("Switch name:{0}, number of ports:{1}, used:{2}".format(sw_name, self.network_objects['switch'][sw_name][0].num_ports,
-                                                                                          self.network_objects['switch'][sw_name][1]))
-                            pcs = ''
-                            for pc_name in self.network_objects['pc']:
-                                if self.network_objects['pc'][pc_name][1] == sw_name:
-                                    pcs = pcs + pc_name + ' '
-                            print('PCs connected: {}'.format(pcs))
+                # Creating VLANs on a switch
+                elif com_stack[0] == 'switch':
+                    if len(com_stack) < 2:
+                        print("Command is not full")
+                        continue
+                    if com_stack[1] == 'vlan':
+                        vlan = self._prompt("Specify a VLAN number (int number): ")
+                        ports_for_vlan = False
+                        while True:
+                            assign_ports = self._prompt("Assign ports to this VLAN? (y or n): ")
+                            if assign_ports == 'y':
+                                ports_for_vlan = self._prompt("Which port numbers to assign to this VLAN? (e.g., 1,10,3,6 no spaces): ").split(',')
+                                break
+                            elif assign_ports == 'n':
+                                break
+                            else:
+                                self._reject("Please, type y or n")
+                                continue
+                        sw_name = self._prompt("Provide a switch name: ")
+                        if self.network_objects['switch'][sw_name]:
+                            self.network_objects['switch'][sw_name][0].create_vlan(vlan)
+                            if ports_for_vlan:
+                                self.network_objects['switch'][sw_name][0].assign_ports_to_vlan(vlan, ports_for_vlan)
+                        else:
+                            print("This switch doesn't exist")
+                            continue
+                    elif com_stack[1] == 'assign':
+                        sw_name = self._prompt("Specify switch name: ")
+                        vlan = self._prompt("Specify VLAN number: ")
+                        ports_for_vlan = self._prompt("Which port numbers to assign to this VLAN? (e.g., 1,10,3,6 no spaces): ").split(',')
+                        if self.network_objects['switch'][sw_name]:
+                            self.network_objects['switch'][sw_name][0].assign_ports_to_vlan(vlan, ports_for_vlan)
+                        else:
+                            print("This switch doesn't exist")
+                            continue
+                    elif com_stack[1] == 'capacity':
+                        if len(com_stack) < 4 or com_stack[2] not in self.network_objects['switch']:
+                            print("Usage: switch capacity <switch_name> <entries|none> [{}]".format('|'.join(Switch.MAC_EVICTION)))
+                            continue
+                        try:
+                            capacity = None if com_stack[3] == 'none' else int(com_stack[3])
+                            self.network_objects['switch'][com_stack[2]][0].set_mac_capacity(capacity, *com_stack[4:5])
+                        except ValueError as error:
+                            print("Invalid input: {}".format(error))
+                            continue
                     else:
-                        print("You haven't created any switches yet")
+                        print("Unrecognized command")
                         continue
-                # Statistics for a specified switch
-                elif com_stack[1] == 'switch':
+
+                # Sending frames between two PCs
+                elif com_stack[0] == 'send':
                     if len(self.network_objects['switch']) == 0:
                         print("You haven't created any switches yet")
                         continue
-                    if len(com_stack) < 3:
-                        print("Switch name is missing")
-                        continue
-                    if self.network_objects['switch'][com_stack[2]]:
-                        print("Switch stats:")
-                        print("Name: {}".format(com_stack[2]))
-                        print("Number of ports: {}".format(self.network_objects['switch'][com_stack[2]][0].num_ports))
-                        print("Ports per VLAN")
-                        vlan_stats = self.network_objects['switch'][com_stack[2]][0].vlan_database
-                        for vlan in vlan_stats:
-                            print(vlan.upper())
-                            for port in vlan_stats[vlan]:
-                                port_number = int(port.split('_')[1])
-                                print("Port: {0}, frames sent:{1}, frames received:{2}".format(port, self.network_objects['switch'][com_stack[2]][0].get_sent_for_port(port_number),
-                                                                                               self.network_objects['switch'][com_stack[2]][0].get_received_for_port(port_number)))
-                        print("MAC table")
-                        print("=" * 10)
-                        for mac in self.network_objects['switch'][com_stack[2]][0].mac_table:
-                            print("Dest. MAC: {0}, dest. port: {1}, VLAN: {2}, age: {3}".format(mac, self.network_objects['switch'][com_stack[2]][0].mac_table[mac][0],
-                                                                                                self.network_objects['switch'][com_stack[2]][0].mac_table[mac][2],
-                                                                                                self.network_objects['switch'][com_stack[2]][0].mac_table[mac][1]))
-                        print("=" * 10)
-                        print("Total sent/received:")
-                        print("Total sent: {0}, total received: {1}".format(self.network_objects['switch'][com_stack[2]][0].total_sent,
-                                                                            self.network_objects['switch'][com_stack[2]][0].total_received))
+                    from_pc = self._prompt("Where to send a frame FROM? (PC name): ")
+                    to_pc = self._prompt("Where to send a frame TO? (PC name): ")
+                    from_mac = self.network_objects['pc'][from_pc][0].mac
+                    # A frame is sent either to a PC or to a broadcast or multicast group address
+                    if to_pc in self.network_objects['pc']:
+                        to_mac = self.network_objects['pc'][to_pc][0].mac
                     else:
-                        print("Specify a switch name")
+                        try:
+                            to_mac = parse_mac(to_pc)
+                        except ValueError:
+                            print("PC with this name doesn't exist")
+                            continue
+                    number_of_frames = int(self._prompt("How many frames? (int number): "))
+                    for n in range(number_of_frames):
+                        if not quiet:
+                            print("Sending a frame: {0}:{1} ---> {2}:{3} ".format(from_pc, format_mac(from_mac), to_pc, format_mac(to_mac)))
+                        self.fabric.send(self.network_objects['pc'][from_pc][0], to_mac)
+                        self.fabric.run()
+
+                # Joining a PC to a multicast group
+                elif com_stack[0] == 'join':
+                    if len(com_stack) < 3 or com_stack[1] not in self.network_objects['pc']:
+                        print("Usage: join <pc_name> <group MAC address>")
+                        continue
+                    try:
+                        self.fabric.join(self.network_objects['pc'][com_stack[1]][0], parse_mac(com_stack[2]))
+                    except ValueError as error:
+                        print("Invalid input: {}".format(error))
                         continue
-                # Show details for a specific PC
-                elif com_stack[1] == 'pc':
-                    if len(self.network_objects['pc']) == 0:
-                        print("You don't have any workstations")
+
+                # Concurrent traffic of all PCs
+                elif com_stack[0] == 'traffic':
+                    if len(self.network_objects['pc']) < 2:
+                        print("You need at least two workstations")
                         continue
+                    try:
+                        frames = int(com_stack[1])
+                        queue_size = int(com_stack[2]) if len(com_stack) > 2 else 64
+                        if len(com_stack) > 3 and com_stack[3] not in ('wait', 'drop'):
+                            raise ValueError("a full queue either makes senders 'wait' or 'drop's frames")
+                        seed = int(com_stack[4]) if len(com_stack) > 4 else 0
+                        engine = StationEngine(self.fabric, queue_size, com_stack[3:4] != ['drop'], seed)
+                    except (IndexError, ValueError) as error:
+                        print("Usage: traffic <frames per PC> [queue size] [wait|drop] [seed]; {}".format(error))
+                        continue
+                    stats = engine.run([station for station, _ in self.network_objects['pc'].values()], frames)
+                    print("Stations: {stations}, frames sent: {sent}, delivered: {delivered}, dropped: {dropped}, "
+                          "longest queue: {max_queue_depth}".format(**stats))
+
+                # Replaying a trace of frames through a switch
+                elif com_stack[0] == 'replay':
                     if len(com_stack) < 3:
-                        print("Specify a PC name for an existing PC")
+                        print("Usage: replay <switch_name> <trace file>")
+                        continue
+                    if com_stack[1] not in self.network_objects['switch']:
+                        print("This switch doesn't exist")
+                        continue
+                    try:
+                        replayed = self.replay_trace(com_stack[1], com_stack[2])
+                    except (OSError, ValueError, IndexError) as error:
+                        print("Error: {}".format(error))
+                        continue
+                    print("Replayed {} frames".format(replayed))
+
+                # Collecting and exporting performance statistics of a switch
+                elif com_stack[0] == 'perf':
+                    if len(com_stack) < 3 or com_stack[1] not in ('on', 'off', 'export'):
+                        print("Usage: perf on <switch_name> [sample_every], perf off <switch_name> or "
+                              "perf export <switch_name> <file>")
+                        continue
+                    if com_stack[2] not in self.network_objects['switch']:
+                        print("This switch doesn't exist")
                         continue
-                    if self.network_objects['pc'][com_stack[2]]:
-                        print("PC stats:")
-                        print("PC name: {0}, MAC address: {1}".format(com_stack[2], self.network_objects['pc'][com_stack[2]][0].mac))
-                        print("Frames sent: {0}, frames received: {1}".format(self.network_objects['pc'][com_stack[2]][0].get_sent_for_port(0),
-                                                                              self.network_objects['pc'][com_stack[2]][0].get_received_for_port(0)))
+                    switch = self.network_objects['switch'][com_stack[2]][0]
+                    if com_stack[1] == 'on':
+                        try:
+                            switch.enable_perf(*(int(arg) for arg in com_stack[3:4]))
+                        except ValueError:
+                            print("Invalid input")
+                            continue
+                    elif com_stack[1] == 'off':
+                        switch.disable_perf()
                     else:
-                        print("PC with this name doesn't exist")
+                        if switch.perf is None or len(com_stack) < 4:
+                            print("Turn statistics on with 'perf on' and give a file name")
+                            continue
+                        # Prometheus text for .prom files, otherwise a JSON line appended to the file
+                        if com_stack[3].endswith('.prom'):
+                            text, mode = switch.perf.to_prometheus(switch, com_stack[2]), 'w'
+                        else:
+                            text, mode = switch.perf.to_jsonl(switch, com_stack[2]), 'a'
+                        try:
+                            with open(com_stack[3], mode) as export_file:
+                                export_file.write(text)
+                        except OSError as error:
+                            print("Error: {}".format(error))
+                            continue
+
+                # Building a whole network from a topology file
+                elif com_stack[0] == 'topology':
+                    if len(com_stack) < 2:
+                        print("Usage: topology <file>")
                         continue
-                else:
-                    print("Unrecognized command")
-                    continue
+                    try:
+                        switches, trunks, pcs = self.load_topology(com_stack[1])
+                    except (OSError, ValueError) as error:
+                        print("Error: {}".format(error))
+                        continue
+                    print("Loaded {} switches, {} trunk links, {} PCs".format(switches, trunks, pcs))
 
-            # Creating VLANs on a switch
-            elif com_stack[0] == 'switch':
-                if len(com_stack) < 2:
-                    print("Command is not full")
-                    continue
-                if com_stack[1] == 'vlan':
-                    vlan = input("Specify a VLAN number (int number): ")
-                    ports_for_vlan = False
-                    while True:
-                        assign_ports = input("Assign ports to this VLAN? (y or n): ")
-                        if assign_ports == 'y':
-                            ports_for_vlan = input("Which port numbers to assign to this VLAN? (e.g., 1,10,3,6 no spaces): ").split(',')
-                            break
-                        elif assign_ports == 'n':
-                            break
+                # Saving and loading snapshots of the whole simulation
+                elif com_stack[0] == 'save' or com_stack[0] == 'load':
+                    if len(com_stack) < 2:
+                        print("Usage: save <file> [incremental] or load <file>")
+                        continue
+                    try:
+                        if com_stack[0] == 'save':
+                            written = self.save(com_stack[1], incremental=com_stack[2:] == ['incremental'])
+                            print("Saved, {} switch records written".format(written))
                         else:
-                            print("Please, type y or n")
+                            self.load(com_stack[1])
+                            print("Loaded")
+                    except (OSError, ValueError) as error:
+                        print("Error: {}".format(error))
+                        continue
+
+                # Streaming per-port statistics to a file
+                elif com_stack[0] == 'stats':
+                    if len(com_stack) < 2 or com_stack[1] not in ('start', 'sample', 'stop'):
+                        print("Usage: stats start <file> [interval seconds] [buffered rows], stats sample or stats stop")
+                        continue
+                    if com_stack[1] == 'start':
+                        if self.stats_stream is not None:
+                            print("Statistics are already streamed to {}".format(self.stats_stream.path))
                             continue
-                    sw_name = input("Provide a switch name: ")
-                    if self.network_objects['switch'][sw_name]:
-                        self.network_objects['switch'][sw_name][0].create_vlan(vlan)
-                        if ports_for_vlan:
-                            self.network_objects['switch'][sw_name][0].assign_ports_to_vlan(vlan, ports_for_vlan)
-                    else:
-                        print("This switch doesn't exist")
+                        try:
+                            self.stats_stream = StatsStream(com_stack[2], *(float(arg) for arg in com_stack[3:5]))
+                        except (IndexError, OSError, ValueError) as error:
+                            print("Error: {}".format(error))
+                            continue
+                        self.stats_stream.begin(self.network_objects['switch'])
+                    elif self.stats_stream is None:
+                        print("Statistics aren't streamed, use 'stats start'")
                         continue
-                elif com_stack[1] == 'assign':
-                    sw_name = input("Specify switch name: ")
-                    vlan = input("Specify VLAN number: ")
-                    ports_for_vlan = input("Which port numbers to assign to this VLAN? (e.g., 1,10,3,6 no spaces): ").split(',')
-                    if self.network_objects['switch'][sw_name]:
-                        self.network_objects['switch'][sw_name][0].assign_ports_to_vlan(vlan, ports_for_vlan)
+                    elif com_stack[1] == 'sample':
+                        self.stats_stream.sample(self.network_objects['switch'])
                     else:
-                        print("This switch doesn't exist")
-                        continue
+                        self.stats_stream.close(self.network_objects['switch'])
+                        print("{} samples, {} rows written to {}".format(self.stats_stream.samples,
+                                                                         self.stats_stream.rows_written,
+                                                                         self.stats_stream.path))
+                        self.stats_stream = None
+
+                # 'quit' command, leaving CLI
+                elif com_stack[0] == 'quit':
+                    if self.stats_stream is not None:
+                        self.stats_stream.close(self.network_objects['switch'])
+                        self.stats_stream = None
+                    break
+
+                # Invalid command
                 else:
                     print("Unrecognized command")
                     continue
-
-            # Sending frames between two PCs
-            elif com_stack[0] == 'send':
-                if len(self.network_objects['switch']) == 0:
-                    print("You haven't created any switches yet")
-                    continue
-                from_pc = input("Where to send a frame FROM? (PC name): ")
-                to_pc = input("Where to send a frame TO? (PC name): ")
-                from_mac = self.network_objects['pc'][from_pc][0].mac
-                to_mac = self.network_objects['pc'][to_pc][0].mac
-                number_of_frames = int(input("How many frames? (int number): "))
-                for n in range(number_of_frames):
-                    print("Sending a frame: {0}:{1} ---> {2}:{3} ".format(from_pc, from_mac, to_pc, to_mac))
-                    self.network_objects['pc'][from_pc][0].send_msg(to_mac)
-                    self.network_objects['pc'][to_pc][0].receive_msg()
-
-            # 'quit' command, leaving CLI
-            elif com_stack[0] == 'quit':
-                break
-
-            # Invalid command
-            else:
-                print("Unrecognized command")
+            except (IndexError, KeyError, ValueError) as error:
+                print("Invalid input: {}".format(error))
                 continue
 
 
@@ -418,6 +2730,12 @@ if __name__ == "__main__":
     session = RuntimeEnv()
     print("Session created")
 
+    # A script file given as an argument is run in batch mode
+    if len(argv) > 1:
+        with open(argv[1]) as script:
+            session.shell(script, quiet=True)
+        exit(0)
+
     print("Shell started\n")
     session.shell()
 
@@ -0,0 +1,275 @@
+"""
+Throughput benchmarks for the switch simulation
+"""
+
+from array import array
+from hashlib import sha256
+from sys import exit
+from time import perf_counter, perf_counter_ns
+import argparse
+import json
+import random
+import tracemalloc
+
+from SwitchSim import Switch, format_mac
+
+
+# Workload generators. Every generator gets a seeded random generator, a number of switch ports, a number of
+# hosts (MAC addresses) and a number of frames, and yields frames as (source MAC, destination MAC, ingress port).
+# Host number i has MAC address i and is connected to port i % num_ports, so every host always sends
+# from the same port
+
+# Every host talks to any other host with the same probability
+
+def uniform_unicast(rnd, num_ports, num_hosts, frames):
+    for _ in range(frames):
+        source = rnd.randrange(num_hosts)
+        yield source, rnd.randrange(num_hosts), source % num_ports
+
+
+# Hosts are picked with Zipf-distributed probabilities, so a few hot hosts carry most of the traffic
+
+def zipf_hot_hosts(rnd, num_ports, num_hosts, frames, skew=1.1):
+    hosts = range(num_hosts)
+    weights = [1 / (rank ** skew) for rank in range(1, num_hosts + 1)]
+    cum_weights = []
+    total = 0
+    for weight in weights:
+        total += weight
+        cum_weights.append(total)
+    sources = rnd.choices(hosts, cum_weights=cum_weights, k=frames)
+    destinations = rnd.choices(hosts, cum_weights=cum_weights, k=frames)
+    for source, destination in zip(sources, destinations):
+        yield source, destination, source % num_ports
+
+
+# Every frame is sent to a host which never sends anything, so the switch never learns it and floods every frame
+
+def flood_storm(rnd, num_ports, num_hosts, frames):
+    for _ in range(frames):
+        source = rnd.randrange(num_hosts)
+        yield source, num_hosts + rnd.randrange(num_hosts), source % num_ports
+
+
+# Ports are split into VLANs of vlan_size ports each (see partition_vlans), and hosts only talk to hosts
+# in their own VLAN
+
+def vlan_partitioned(rnd, num_ports, num_hosts, frames, vlan_size=8):
+    for _ in range(frames):
+        source = rnd.randrange(num_hosts)
+        port = source % num_ports
+        peer_port = port - port % vlan_size + rnd.randrange(vlan_size)
+        if peer_port >= min(num_ports, num_hosts):
+            peer_port = port
+        # Hosts connected to peer_port are peer_port, peer_port + num_ports, peer_port + 2 * num_ports, ...
+        destination = peer_port + num_ports * rnd.randrange((num_hosts - 1 - peer_port) // num_ports + 1)
+        yield source, destination, port
+
+
+def partition_vlans(switch, vlan_size=8):
+    for vlan, block in enumerate(range(0, switch.num_ports, vlan_size), start=2):
+        switch.create_vlan(vlan)
+        switch.assign_ports_to_vlan(vlan, range(block, min(block + vlan_size, switch.num_ports)))
+
+
+# Active hosts form a window which slides over the host numbers, so hosts keep leaving the network and their
+# MAC addresses are removed by aging, while new hosts keep coming and are learned
+
+def churn_window(num_hosts):
+    return max(num_hosts // 10, 2)
+
+
+def mac_churn(rnd, num_ports, num_hosts, frames, window=None):
+    window = window or churn_window(num_hosts)
+    for frame in range(frames):
+        start = frame * num_hosts // max(frames, 1)
+        source = start + rnd.randrange(window)
+        yield source, start + rnd.randrange(window), source % num_ports
+
+
+# Workload name -> (frame generator, switch setup or None)
+WORKLOADS = {
+    'uniform': (uniform_unicast, None),
+    'zipf': (zipf_hot_hosts, None),
+    'flood': (flood_storm, None),
+    'vlan': (vlan_partitioned, partition_vlans),
+    'churn': (mac_churn, None),
+}
+
+
+# Default MAC aging time in frames. Most workloads keep every host in the MAC table (2 x hosts). Under churn
+# a host is active while the window passes over it, for window x frames / hosts frames, so entries of hosts which
+# left age out soon after and the aging path is measured whatever the number of hosts
+
+def default_aging(workload, num_hosts, frames):
+    if workload == 'churn':
+        return max(churn_window(num_hosts) * frames // num_hosts, 2)
+    return 2 * num_hosts
+
+
+# Build a switch for a workload, optionally with a bounded MAC table
+
+def make_switch(workload, num_ports, aging_time, capacity=None, eviction='lru'):
+    switch = Switch(num_ports, aging_time, capacity, eviction)
+    setup = WORKLOADS[workload][1]
+    if setup is not None:
+        setup(switch)
+    return switch
+
+
+# A digest of forwarding results: decisions for all frames plus the final counters and MAC table of a switch
+
+def results_digest(switch, decisions):
+    digest = sha256()
+    digest.update(json.dumps(list(decisions)).encode())
+    ports = range(switch.num_ports)
+    digest.update(bytes(array('Q', [switch.get_sent_for_port(port) for port in ports])))
+    digest.update(bytes(array('Q', [switch.get_received_for_port(port) for port in ports])))
+    digest.update(json.dumps([[format_mac(mac), entry.port, switch.get_mac_age(mac), 'vlan{}'.format(entry.vlan)]
+                              for mac, entry in switch.mac_table.items()]).encode())
+    return digest.hexdigest()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+# Run one scenario: the reference run sends frames one by one with Switch.send_frame and times every frame,
+# then the same frames are sent as one batch with Switch.send_frames. Results of both runs must be the same.
+# Peak memory is measured in a separate run, since tracing memory allocations slows everything down
+
+def run_scenario(workload, num_ports, num_hosts, frames, seed, aging_time, measure_memory=True, capacity=None,
+                 eviction='lru'):
+    rnd = random.Random(seed)
+    source_macs, dest_macs, port_nums = [], [], []
+    for source_mac, dest_mac, port_num in WORKLOADS[workload][0](rnd, num_ports, num_hosts, frames):
+        source_macs.append(source_mac)
+        dest_macs.append(dest_mac)
+        port_nums.append(port_num)
+
+    switch = make_switch(workload, num_ports, aging_time, capacity, eviction)
+    send_frame = switch.send_frame
+    latencies = []
+    decisions = []
+    start = perf_counter()
+    for source_mac, dest_mac, port_num in zip(source_macs, dest_macs, port_nums):
+        frame_start = perf_counter_ns()
+        decisions.append(send_frame(source_mac, dest_mac, port_num))
+        latencies.append(perf_counter_ns() - frame_start)
+    single_time = perf_counter() - start
+    reference = results_digest(switch, decisions)
+    mac_table_size = len(switch.mac_table)
+    evictions, learn_failures = switch.mac_evictions, switch.learn_failures
+
+    switch = make_switch(workload, num_ports, aging_time, capacity, eviction)
+    start = perf_counter()
+    decisions = switch.send_frames(source_macs, dest_macs, port_nums)
+    batch_time = perf_counter() - start
+    digest = results_digest(switch, decisions)
+
+    peak_memory = None
+    if measure_memory:
+        tracemalloc.start()
+        switch = make_switch(workload, num_ports, aging_time, capacity, eviction)
+        switch.send_frames(source_macs, dest_macs, port_nums)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del switch
+
+    latencies.sort()
+    return {
+        'workload': workload,
+        'ports': num_ports,
+        'hosts': num_hosts,
+        'frames': frames,
+        'seed': seed,
+        'aging_time': aging_time,
+        'capacity': capacity,
+        'eviction': eviction,
+        'mac_table': mac_table_size,
+        'capacity_evictions': evictions,
+        'learn_failures': learn_failures,
+        'frames_per_sec': frames / single_time if single_time else 0,
+        'batch_frames_per_sec': frames / batch_time if batch_time else 0,
+        'latency_p50_us': percentile(latencies, 0.50) / 1000,
+        'latency_p99_us': percentile(latencies, 0.99) / 1000,
+        'latency_p999_us': percentile(latencies, 0.999) / 1000,
+        'peak_memory_mb': peak_memory / 2 ** 20 if peak_memory is not None else None,
+        'digest': reference,
+        'batch_matches': digest == reference,
+    }
+
+
+def scenario_key(result):
+    key = '{workload}/{ports}/{hosts}/{frames}/{seed}/{aging_time}'.format(**result)
+    if result['capacity'] is not None:
+        key += '/{capacity}/{eviction}'.format(**result)
+    return key
+
+
+def print_result(result):
+    memory = '{:.1f}'.format(result['peak_memory_mb']) if result['peak_memory_mb'] is not None else '-'
+    print("{0:<8} ports:{1:<7} hosts:{2:<8} mac table:{3:<8} {4:>10.0f} fps, batch {5:>10.0f} fps, "
+          "latency p50/p99/p99.9: {6:.1f}/{7:.1f}/{8:.1f} us, peak memory: {9} MB, batch matches: {10}"
+          .format(result['workload'], result['ports'], result['hosts'], result['mac_table'], result['frames_per_sec'],
+                  result['batch_frames_per_sec'], result['latency_p50_us'], result['latency_p99_us'],
+                  result['latency_p999_us'], memory, result['batch_matches']))
+    if result['capacity'] is not None:
+        print("  MAC table capacity: {capacity} ({eviction}), evicted: {capacity_evictions}, "
+              "not learned: {learn_failures}".format(**result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure forwarding throughput of the switch simulation")
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), help="comma separated workload names")
+    parser.add_argument('--ports', default='8,48,1024', help="comma separated switch sizes")
+    parser.add_argument('--hosts', default='10,1000,10000', help="comma separated numbers of hosts (MAC addresses)")
+    parser.add_argument('--frames', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--aging', type=int, default=0,
+                        help="MAC aging time in frames; 0 keeps every host in the MAC table (2 x hosts), "
+                             "except for churn, where hosts age out once the window passes them")
+    parser.add_argument('--capacity', type=int, help="limit MAC tables to a number of entries")
+    parser.add_argument('--eviction', default='lru', choices=Switch.MAC_EVICTION,
+                        help="which entry leaves a full MAC table")
+    parser.add_argument('--full', action='store_true',
+                        help="run all sizes: 8 to 100k ports and 10 to 1M hosts (takes a long time)")
+    parser.add_argument('--no-memory', action='store_true', help="skip peak memory measurement")
+    parser.add_argument('--save-baseline', help="save results digests to a JSON file")
+    parser.add_argument('--baseline', help="check results digests against a JSON file saved by --save-baseline")
+    args = parser.parse_args()
+
+    ports = [8, 48, 1024, 100000] if args.full else [int(n) for n in args.ports.split(',')]
+    hosts = [10, 1000, 100000, 1000000] if args.full else [int(n) for n in args.hosts.split(',')]
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    digests = {}
+    failures = 0
+    for workload in args.workloads.split(','):
+        for num_ports in ports:
+            for num_hosts in hosts:
+                result = run_scenario(workload, num_ports, num_hosts, args.frames, args.seed,
+                                      args.aging or default_aging(workload, num_hosts, args.frames), not args.no_memory,
+                                      args.capacity, args.eviction)
+                print_result(result)
+                key = scenario_key(result)
+                digests[key] = result['digest']
+                if not result['batch_matches']:
+                    failures += 1
+                if key in baseline and baseline[key] != result['digest']:
+                    print("  results differ from the baseline")
+                    failures += 1
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(digests, baseline_file, indent=1, sort_keys=True)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    exit(main())
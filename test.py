@@ -1,5 +1,734 @@
 #!/usr/bin/env python
 
-import sys
+"""
+Tests of the switch simulation; run with 'python test.py'
+"""
 
-sys.exit(0)
+from contextlib import redirect_stdout
+import csv
+from io import StringIO
+import json
+import os
+import random
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from SwitchSim import (BROADCAST_MAC, FRAME_FILTERED, FRAME_FLOODED, FRAME_MULTICAST, GROUP_BIT, DeviceRegistry,
+                       Fabric, RuntimeEnv, Station, StationEngine, StatsStream, Switch, format_mac, parse_mac)
+
+
+# The original MAC table rule: every frame is one step, a MAC address gets age 0 when it's seen and every other
+# address gets one step older, and addresses which reached age 5 are removed before the frame is forwarded.
+# A MAC address keeps the port and VLAN it was learned with until it's removed
+class ReferenceSwitch:
+
+    def __init__(self, num_ports):
+        self.num_ports = num_ports
+        self.port_vlan = dict.fromkeys(range(num_ports), 1)
+        self.mac_table = {}    # MAC -> [port, age, VLAN]
+        self.sent = [0] * num_ports
+        self.received = [0] * num_ports
+
+    def assign_ports_to_vlan(self, vlan, ports):
+        for port in ports:
+            if port < self.num_ports:
+                self.port_vlan[port] = vlan
+
+    def send_frame(self, source_mac, dest_mac, port_num):
+        if source_mac not in self.mac_table:
+            self.mac_table[source_mac] = [port_num, 0, self.port_vlan[port_num]]
+        for mac, entry in self.mac_table.items():
+            entry[1] = 0 if mac == source_mac else entry[1] + 1
+        for mac in [mac for mac, entry in self.mac_table.items() if entry[1] >= 5]:
+            del self.mac_table[mac]
+        self.received[port_num] += 1
+        vlan = self.mac_table[source_mac][2]
+        if dest_mac in self.mac_table:
+            if self.mac_table[dest_mac][2] == vlan:
+                self.sent[self.mac_table[dest_mac][0]] += 1
+        else:
+            for port in range(self.num_ports):
+                if port != port_num and self.port_vlan[port] == vlan:
+                    self.sent[port] += 1
+
+
+# Everything observable about a switch: counters, MAC table in last-seen order and buffered frames
+
+def switch_state(switch):
+    ports = range(switch.num_ports)
+    return ([switch.get_sent_for_port(port) for port in ports], [switch.get_received_for_port(port) for port in ports],
+            [(mac, entry.port, switch.get_mac_age(mac), entry.vlan) for mac, entry in switch.mac_table.items()],
+            [sorted(switch.get_buffered_for_port(port).items()) for port in ports],
+            switch.total_sent, switch.total_received)
+
+
+# A switch with VLANs 2 and 3, a forwarding and a blocked trunk port and a multicast group
+
+def make_switch(num_ports=16, aging_time=20, capacity=None, eviction='lru'):
+    switch = Switch(num_ports, aging_time, capacity, eviction)
+    switch.create_vlan(2)
+    switch.create_vlan(3)
+    switch.assign_ports_to_vlan(2, range(4, 8))
+    switch.assign_ports_to_vlan(3, range(8, 11))
+    switch.set_trunk(num_ports - 1)
+    switch.set_trunk(num_ports - 2, False)
+    switch.join_group(GROUP_BIT | 1, 1)
+    switch.join_group(GROUP_BIT | 1, 5)
+    return switch
+
+
+def random_frames(rnd, num_ports, count, num_hosts=30):
+    home = {mac: rnd.randrange(num_ports - 2) for mac in range(1, num_hosts + 1)}
+    frames = []
+    for _ in range(count):
+        source_mac = rnd.choice(list(home))
+        dest_mac = rnd.choice([rnd.randrange(1, 2 * num_hosts), BROADCAST_MAC, GROUP_BIT | 1])
+        port_num = home[source_mac] if rnd.random() < 0.9 else rnd.randrange(num_ports)
+        frames.append((source_mac, dest_mac, port_num))
+    return frames
+
+
+# Run a shell script quietly; returns what the shell printed
+
+def run_script(env, lines):
+    output = StringIO()
+    with redirect_stdout(output):
+        env.shell(lines, quiet=True)
+    return output.getvalue()
+
+
+class MacTest(unittest.TestCase):
+
+    def test_parse_mac(self):
+        self.assertEqual(parse_mac('0000.0000.0001'), 1)
+        self.assertEqual(parse_mac('AbCd.0000.00fF'), 0xabcd000000ff)
+        self.assertEqual(format_mac(parse_mac('ffff.ffff.ffff')), 'ffff.ffff.ffff')
+        for text in ('0x00.0000.0001', '0_00.0000.0001', '+000.0000.0001', '-000.0000.0001', ' 000.0000.0001',
+                     '000g.0000.0001', '0000.0000.001', '0000-0000-0001'):
+            with self.assertRaises(ValueError):
+                parse_mac(text)
+
+
+class SendFrameTest(unittest.TestCase):
+
+    def test_matches_original_aging_rule(self):
+        for seed in range(300):
+            rnd = random.Random(seed)
+            num_ports = rnd.randint(2, 12)
+            switch, reference = Switch(num_ports), ReferenceSwitch(num_ports)
+            switch.create_vlan(2)
+            for _ in range(rnd.randint(1, 150)):
+                if rnd.random() < 0.03:
+                    vlan, ports = rnd.choice([1, 2]), [rnd.randrange(num_ports) for _ in range(3)]
+                    switch.assign_ports_to_vlan(vlan, ports)
+                    reference.assign_ports_to_vlan(vlan, ports)
+                source_mac, dest_mac = rnd.randrange(1, 12), rnd.randrange(1, 12)
+                port_num = rnd.randrange(num_ports)
+                switch.send_frame(source_mac, dest_mac, port_num)
+                reference.send_frame(source_mac, dest_mac, port_num)
+                self.assertEqual([switch.get_sent_for_port(port) for port in range(num_ports)], reference.sent)
+                self.assertEqual([switch.get_received_for_port(port) for port in range(num_ports)], reference.received)
+                self.assertEqual({mac: (entry.port, switch.get_mac_age(mac), entry.vlan)
+                                  for mac, entry in switch.mac_table.items()},
+                                 {mac: tuple(entry) for mac, entry in reference.mac_table.items()})
+
+    def test_decisions(self):
+        switch = make_switch()
+        self.assertEqual(switch.send_frame(1, 2, 0), FRAME_FLOODED)
+        self.assertEqual(switch.send_frame(2, 1, 3), 0)
+        self.assertEqual(switch.send_frame(3, 1, 4), FRAME_FILTERED)
+        self.assertEqual(switch.get_buffered_for_port(0), {})
+
+    def test_bad_vlan_assignment_leaves_switch_unchanged(self):
+        switch, reference = Switch(8), Switch(8)
+        for sw in (switch, reference):
+            sw.create_vlan(2)
+            sw.send_frame(1, BROADCAST_MAC, 0)
+        with self.assertRaises(ValueError):
+            switch.assign_ports_to_vlan(2, ['3', 'x'])
+        self.assertEqual(switch.vlan_database, reference.vlan_database)
+        for sw in (switch, reference):
+            sw.send_frame(1, BROADCAST_MAC, 0)
+        self.assertEqual(switch_state(switch), switch_state(reference))
+        self.assertEqual(sum(switch.get_sent_for_port(port) for port in range(8)), switch.total_sent)
+
+    def test_perf_stats(self):
+        for eviction in (None,) + Switch.MAC_EVICTION:
+            rnd = random.Random(3)
+            frames = random_frames(rnd, 16, 500)
+            capacity = None if eviction is None else 8
+            plain = make_switch(aging_time=25, capacity=capacity, eviction=eviction or 'lru')
+            measured = make_switch(aging_time=25, capacity=capacity, eviction=eviction or 'lru')
+            measured.enable_perf(sample_every=7)
+            decisions = [plain.send_frame(*frame) for frame in frames]
+            self.assertEqual([measured.send_frame(*frame) for frame in frames], decisions)
+            self.assertEqual(switch_state(measured), switch_state(plain))
+            report = measured.perf.report(measured)
+            self.assertEqual(report['frames'], len(frames))
+            self.assertEqual(report['floods'], decisions.count(FRAME_FLOODED))
+            self.assertEqual(report['multicast'], decisions.count(FRAME_MULTICAST))
+            self.assertEqual(report['filtered'], decisions.count(FRAME_FILTERED))
+            self.assertEqual(report['stage_calls']['lookup'], len(frames) // 7)
+
+    def test_perf_exports(self):
+        for capacity in (None, 8):
+            switch = make_switch(capacity=capacity)
+            switch.enable_perf(sample_every=3)
+            frames = random_frames(random.Random(5), 16, 100)
+            for frame in frames[:50]:
+                switch.send_frame(*frame)
+            switch.send_frames(*zip(*frames[50:]))
+            report = switch.perf.report(switch)
+            record = json.loads(switch.perf.to_jsonl(switch, 'SW_1'))
+            self.assertEqual(record.pop('switch'), 'SW_1')
+            self.assertIsInstance(record.pop('time'), float)
+            self.assertEqual(record, report)
+            text = switch.perf.to_prometheus(switch, 'SW_1')
+            self.assertTrue(text.endswith('\n'))
+            samples = {}
+            types = {}
+            for line in text.splitlines():
+                if line.startswith('# TYPE '):
+                    metric, kind = line.split()[2:]
+                    self.assertNotIn(metric, types)
+                    types[metric] = kind
+                else:
+                    sample, value = line.split(' ')
+                    metric = sample.split('{')[0]
+                    self.assertIn(metric, types)
+                    self.assertEqual(types[metric] == 'counter', metric.endswith('_total'), metric)
+                    samples[sample] = float(value)
+            self.assertEqual(samples['switchsim_frames_total{switch="SW_1"}'], 100)
+            self.assertEqual(samples['switchsim_floods_total{switch="SW_1"}'], report['floods'])
+            self.assertEqual(samples['switchsim_stage_calls_total{switch="SW_1",stage="batch"}'], 1)
+            self.assertEqual(samples['switchsim_stage_calls_total{switch="SW_1",stage="lookup"}'], 50 // 3)
+            # A MAC table without a capacity has no capacity metric
+            self.assertEqual(samples.get('switchsim_mac_capacity{switch="SW_1"}'), capacity)
+
+    def test_lazy_ports(self):
+        switch = Switch(1000000)
+        self.assertEqual((switch._slots, len(switch._sent), len(switch._received), switch._buffers), ({}, 0, 0, []))
+        switch.create_vlan(2)
+        switch.assign_ports_to_vlan(2, [10, 20])
+        # Floods reach all ports of a VLAN without giving them slots; only ports which are used get them
+        self.assertEqual(switch.send_frame(1, BROADCAST_MAC, 0), FRAME_FLOODED)
+        self.assertEqual(switch.send_frame(2, 1, 999999), 0)
+        self.assertEqual(switch.send_frames([3, 4], [BROADCAST_MAC, 1], [5, 10]), [FRAME_FLOODED, FRAME_FILTERED])
+        self.assertEqual(sorted(switch._slots), [0, 5, 10, 20, 999999])
+        self.assertEqual(len(switch._sent), 5)
+        self.assertEqual((switch.get_sent_for_port(500000), switch.get_sent_for_port(20)), (2, 0))
+        self.assertEqual(switch.get_sent_for_port(0), 2)
+        self.assertEqual((switch.total_sent, switch.total_received), (2 * (1000000 - 3) + 1, 4))
+        with self.assertRaises(IndexError):
+            switch.send_frame(1, 2, 1000000)
+
+
+class BatchTest(unittest.TestCase):
+
+    def check_batch(self, capacity=None, eviction='lru', seeds=range(40)):
+        for seed in seeds:
+            rnd = random.Random(seed)
+            aging_time = rnd.randint(1, 40)
+            frames = random_frames(rnd, 16, rnd.randint(1, 400))
+            single = make_switch(aging_time=aging_time, capacity=capacity, eviction=eviction)
+            decisions = [single.send_frame(*frame) for frame in frames]
+            for send in ('send_frames', 'send_frames_parallel'):
+                batch = make_switch(aging_time=aging_time, capacity=capacity, eviction=eviction)
+                columns = [list(column) for column in zip(*frames)]
+                if send == 'send_frames':
+                    self.assertEqual(batch.send_frames(*columns), decisions, seed)
+                else:
+                    self.assertEqual(batch.send_frames_parallel(*columns, workers=1 + seed % 3), decisions, seed)
+                self.assertEqual(switch_state(batch), switch_state(single), (send, seed))
+                self.assertEqual((batch.mac_evictions, batch.learn_failures),
+                                 (single.mac_evictions, single.learn_failures))
+
+    def test_unbounded(self):
+        self.check_batch()
+
+    def test_capacity_policies(self):
+        for eviction in Switch.MAC_EVICTION:
+            self.check_batch(5, eviction, range(15))
+
+    def test_bad_port_leaves_switch_unchanged(self):
+        for send in ('send_frames', 'send_frames_parallel'):
+            switch = make_switch()
+            switch.send_frame(5, 6, 0)
+            state = switch_state(switch)
+            with self.assertRaises(IndexError):
+                getattr(switch, send)([1, 3], [2, 2], [1, 99])
+            self.assertEqual(switch_state(switch), state)
+            self.assertEqual(switch._clock, 1)
+        with self.assertRaises(IndexError):
+            switch.send_frame(3, 2, -1)
+        self.assertEqual(switch_state(switch), state)
+
+    def test_batches_in_a_row(self):
+        rnd = random.Random(7)
+        single, batch = make_switch(aging_time=15), make_switch(aging_time=15)
+        for _ in range(10):
+            frames = random_frames(rnd, 16, rnd.randint(0, 100))
+            decisions = [single.send_frame(*frame) for frame in frames]
+            self.assertEqual(batch.send_frames(*zip(*frames)) if frames else [], decisions)
+            self.assertEqual(switch_state(batch), switch_state(single))
+
+    def test_group_sources_are_not_learned(self):
+        frames = [(1, 2, 0), (BROADCAST_MAC, 1, 3), (GROUP_BIT | 1, 1, 4), (2, BROADCAST_MAC, 2), (3, 1, 3)]
+        single, batch = make_switch(capacity=2), make_switch(capacity=2)
+        decisions = [single.send_frame(*frame) for frame in frames]
+        self.assertEqual(batch.send_frames(*zip(*frames)), decisions)
+        self.assertEqual(switch_state(batch), switch_state(single))
+        self.assertEqual(list(single.mac_table), [2, 3])
+        self.assertEqual(decisions[3], FRAME_FLOODED)
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def make_env(self):
+        env = RuntimeEnv()
+        run_script(env, ['create switch SW_1 12', 'create switch SW_2 12', 'switch vlan 2 y 3,4,5 SW_1',
+                         'create trunk SW_1 11 SW_2 11 1',
+                         'create pc PC_1 SW_1 0000.0000.0001 0', 'create pc PC_2 SW_1 0000.0000.0002 3',
+                         'create pc PC_3 SW_2 0000.0000.0003 0', 'create pc PC_4 SW_1 0000.0000.0004 1',
+                         'join PC_3 0100.0000.0001', 'send PC_1 PC_3 3', 'send PC_4 0100.0000.0001 2',
+                         'send PC_2 ffff.ffff.ffff 1'])
+        return env
+
+    def env_state(self, env):
+        return ({name: switch_state(switch) for name, (switch, _) in env.network_objects['switch'].items()},
+                {name: (station.mac, sw_name, station.switch_port, station.total_sent, station.total_received,
+                         sorted(station.groups))
+                 for name, (station, sw_name) in env.network_objects['pc'].items()})
+
+    def test_round_trip(self):
+        env = self.make_env()
+        self.assertEqual(env.save(self.path('full.snap')), 2)
+        loaded = RuntimeEnv()
+        loaded.load(self.path('full.snap'))
+        self.assertEqual(self.env_state(loaded), self.env_state(env))
+        # Both simulations go on in the same way
+        script = ['send PC_3 PC_1 2', 'send PC_1 PC_4 1', 'send PC_2 PC_9 1', 'send PC_1 0100.0000.0001 1']
+        run_script(env, script)
+        run_script(loaded, script)
+        self.assertEqual(self.env_state(loaded), self.env_state(env))
+
+    def test_incremental(self):
+        env = self.make_env()
+        env.save(self.path('full.snap'))
+        run_script(env, ['send PC_3 PC_3 1'])
+        self.assertEqual(env.save(self.path('step.snap'), incremental=True), 1)
+        loaded = RuntimeEnv()
+        loaded.load(self.path('step.snap'))
+        self.assertEqual(self.env_state(loaded), self.env_state(env))
+        with self.assertRaises(ValueError):
+            loaded.save(self.path('full.snap'), incremental=True)
+
+    def test_oldest_eviction_order(self):
+        env = self.make_env()
+        env.network_objects['switch']['SW_1'][0].set_mac_capacity(3, 'oldest')
+        # PC_1 is learned first but seen last, so the order of learning differs from the MAC table's order
+        run_script(env, ['send PC_2 PC_4 1', 'send PC_4 PC_2 1', 'send PC_3 PC_2 1', 'send PC_1 PC_2 1'])
+        env.save(self.path('full.snap'))
+        loaded = RuntimeEnv()
+        loaded.load(self.path('full.snap'))
+        script = ['send PC_3 PC_1 1', 'send PC_2 PC_1 1', 'send PC_4 PC_3 1', 'send PC_1 PC_4 1']
+        run_script(env, script)
+        run_script(loaded, script)
+        self.assertEqual(self.env_state(loaded), self.env_state(env))
+        self.assertEqual(loaded.network_objects['switch']['SW_1'][0].mac_evictions,
+                         env.network_objects['switch']['SW_1'][0].mac_evictions)
+
+    def test_snapshot_permissions(self):
+        env = self.make_env()
+        mask = os.umask(0o022)
+        try:
+            env.save(self.path('full.snap'))
+            self.assertEqual(os.stat(self.path('full.snap')).st_mode & 0o777, 0o644)
+            os.chmod(self.path('full.snap'), 0o640)
+            env.save(self.path('full.snap'))
+            self.assertEqual(os.stat(self.path('full.snap')).st_mode & 0o777, 0o640)
+        finally:
+            os.umask(mask)
+
+    def test_damaged_snapshots(self):
+        env = self.make_env()
+        env.save(self.path('full.snap'))
+        with open(self.path('full.snap'), 'rb') as snapshot:
+            data = snapshot.read()
+        index_offset = int.from_bytes(data[8:16], 'little')
+        index = json.loads(data[index_offset:])
+
+        def with_record(sw_name, offset, length):
+            damaged = json.loads(json.dumps(index))
+            damaged['switches'][sw_name][1:3] = [offset, length]
+            return data[:index_offset] + json.dumps(damaged).encode()
+
+        offset, length = index['switches']['SW_1'][1:3]
+        files = {'empty.snap': b'', 'short.snap': data[:10], 'magic.snap': b'SWSIMSN0' + data[8:],
+                 'no_index.snap': data[:index_offset], 'index.snap': data[:index_offset] + b'{"switches": 1}',
+                 'short_record.snap': with_record('SW_1', offset, length - 8),
+                 'tiny_record.snap': with_record('SW_1', offset, 8),
+                 'outside.snap': with_record('SW_2', len(data), length)}
+        state = self.env_state(env)
+        for name, content in files.items():
+            with open(self.path(name), 'wb') as snapshot:
+                snapshot.write(content)
+            output = run_script(env, ['load {}'.format(self.path(name)), 'show network'])
+            self.assertTrue(output.startswith("Error: "), (name, output))
+            self.assertEqual(self.env_state(env), state)
+
+    def test_save_over_loaded_snapshot(self):
+        env = self.make_env()
+        env.save(self.path('full.snap'))
+        run_script(env, ['send PC_3 PC_3 1'])
+        env.save(self.path('step.snap'), incremental=True)
+        # Switches which aren't used after loading are still read from the files being overwritten:
+        # from the start of the incremental chain, then from the snapshot itself
+        for name in ('step.snap', 'full.snap'):
+            loaded = RuntimeEnv()
+            loaded.load(self.path(name))
+            self.assertEqual(loaded.save(self.path('full.snap')), 2)
+            reloaded = RuntimeEnv()
+            reloaded.load(self.path('full.snap'))
+            self.assertEqual(self.env_state(reloaded), self.env_state(env))
+            self.assertEqual(self.env_state(loaded), self.env_state(reloaded))
+
+
+class ScriptTest(unittest.TestCase):
+
+    def test_inline_arguments_and_comments(self):
+        env = RuntimeEnv()
+        output = run_script(env, ['# a comment', '', 'create switch SW_1 10', 'switch vlan 100 y 0,1,2,3,4 SW_1',
+                                  'create pc PC_1 SW_1 0000.0000.0001 0', 'create pc PC_2 SW_1 0000.0000.0002 3',
+                                  'send PC_1 PC_2 5', 'show pc PC_2'])
+        switch = env.network_objects['switch']['SW_1'][0]
+        self.assertEqual(switch.vlan_database[100], [0, 1, 2, 3, 4])
+        self.assertEqual(env.network_objects['pc']['PC_1'][0].mac, 1)
+        self.assertEqual(switch.total_received, 5)
+        self.assertIn("Frames sent: 0, frames received: 5", output)
+
+    def test_missing_argument_in_script(self):
+        env = RuntimeEnv()
+        output = run_script(env, ['create switch SW_1', 'create switch SW_2 4'])
+        self.assertIn("Missing argument", output)
+        self.assertEqual(list(env.network_objects['switch']), ['SW_2'])
+
+    def test_failed_inline_answer_gives_up_command(self):
+        env = RuntimeEnv()
+        output = run_script(env, ['create switch SW 12', 'create switch SW 12', 'switch vlan 5 x 1 SW',
+                                  'create pc PC_1 SW 0000.0000.0001 40', 'create pc PC_1 SW 0000.0000.0001 4'])
+        self.assertIn("Names must be unique", output)
+        self.assertEqual(list(env.network_objects['switch']), ['SW'])
+        self.assertNotIn(5, env.network_objects['switch']['SW'][0].vlan_db)
+        self.assertEqual(env.network_objects['pc']['PC_1'][0].switch_port, 4)
+        # Typed in answers are asked again
+        with patch('builtins.input', side_effect=['create switch SW 12', 'create switch', 'SW', 'SW_2', '8', 'quit']):
+            with redirect_stdout(StringIO()):
+                env.shell()
+        self.assertEqual(list(env.network_objects['switch']), ['SW', 'SW_2'])
+
+    def test_group_address_of_pc(self):
+        env = RuntimeEnv()
+        output = run_script(env, ['create switch SW 4', 'create pc A SW 0000.0000.0001 0',
+                                  'create pc B SW ffff.ffff.ffff 1', 'create pc B SW 0100.0000.0001 1',
+                                  'create pc C SW 0000.0000.0003 2', 'send A ffff.ffff.ffff 1'])
+        self.assertEqual(output.count("is a group address"), 2)
+        self.assertEqual(sorted(env.network_objects['pc']), ['A', 'C'])
+        self.assertEqual(env.network_objects['pc']['C'][0].total_received, 1)
+        with self.assertRaises(ValueError):
+            Station(BROADCAST_MAC, env.network_objects['switch']['SW'][0], 3)
+
+    def test_prompted_arguments(self):
+        env = RuntimeEnv()
+        with patch('builtins.input', side_effect=['create switch', 'SW_1', '4', 'create pc PC_1', 'SW_1',
+                                                  '0000.0000.0001', '2', 'quit']):
+            with redirect_stdout(StringIO()):
+                env.shell()
+        self.assertEqual(env.network_objects['switch']['SW_1'][0].num_ports, 4)
+        self.assertEqual(env.network_objects['pc']['PC_1'][0].switch_port, 2)
+
+    def test_replay_errors(self):
+        with tempfile.TemporaryDirectory() as directory:
+            traces = {'good.csv': 'src,dst,port\n0000.0000.0001,0000.0000.0002,0\n\n0000.0000.0002,0000.0000.0001,1\n',
+                      'bad_mac.csv': '0000.0000.0001,0000.0000.0002,0\nnot a mac,0000.0000.0001,1\n',
+                      'bad_port.csv': '0000.0000.0001,0000.0000.0002,9\n',
+                      'short.csv': '0000.0000.0001,0000.0000.0002,0\n0000.0000.0001,0000.0000.0002\n',
+                      'no_port.csv': '0000.0000.0001,0000.0000.0002,0\n0000.0000.0001,0000.0000.0002,x\n',
+                      'bad.jsonl': '{"src_mac": "0000.0000.0001", "dst_mac": "0000.0000.0002"}\n'}
+            for name, text in traces.items():
+                with open(os.path.join(directory, name), 'w') as trace:
+                    trace.write(text)
+            env = RuntimeEnv()
+            lines = ['create switch SW_1 4'] + ['replay SW_1 {}'.format(os.path.join(directory, name))
+                                                for name in list(traces) + ['missing.csv']]
+            output = run_script(env, lines).splitlines()
+            self.assertEqual(output[0], "Replayed 2 frames")
+            for line in output[1:5]:
+                self.assertTrue(line.startswith("Error: ") and "0 frames were replayed" in line, line)
+            self.assertIn("bad.jsonl:1", output[5])
+            self.assertIn("No such file", output[6])
+            self.assertEqual(env.network_objects['switch']['SW_1'][0].total_received, 2)
+
+    def test_topology_errors(self):
+        valid = {'switches': [{'name': 'SW_1', 'ports': 8}],
+                 'pcs': [{'name': 'PC_1', 'switch': 'SW_1', 'mac': '0000.0000.0001', 'port': 0,
+                          'groups': ['0100.0000.0001']}]}
+        bad = [([valid['switches']], 'Topology must be a JSON object'),
+               ({'switches': ['SW_1']}, 'switches[0]: must be an object'),
+               ({'switches': [{'name': 1, 'ports': 8}]}, "switches[0]: 'name' must be a string"),
+               ({'switches': [{'name': 'SW_1', 'ports': 8, 'vlans': [2]}]}, "switches[0]: 'vlans' must be an object"),
+               (dict(valid, pcs=[dict(valid['pcs'][0], mac=1)]), "pcs[0]: 'mac' must be a string"),
+               (dict(valid, pcs=[dict(valid['pcs'][0], groups='0100.0000.0001')]), "pcs[0]: 'groups' must be a list"),
+               (dict(valid, pcs=[dict(valid['pcs'][0], groups=[1])]), 'pcs[0]: Group 1 must be a string')]
+        env = RuntimeEnv()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'topology.json')
+            for topology, message in bad + [(valid, None)]:
+                with open(path, 'w') as topology_file:
+                    json.dump(topology, topology_file)
+                if message is None:
+                    self.assertEqual(env.load_topology(path), (1, 0, 1))
+                else:
+                    with self.assertRaises(ValueError) as error:
+                        env.load_topology(path)
+                    self.assertEqual(str(error.exception), message)
+
+    def test_duplicates_are_rejected(self):
+        registry = DeviceRegistry()
+        switch = Switch(4)
+        registry.add_switch('SW_1', switch)
+        registry.add_pc('PC_1', Station(1, switch, 0), 'SW_1')
+        for name, mac, port, sw_name in (('SW_1', 2, 1, 'SW_1'), ('PC_1', 2, 1, 'SW_1'), ('PC_2', 1, 1, 'SW_1'),
+                                         ('PC_2', 2, 0, 'SW_1'), ('PC_2', 2, 4, 'SW_1'), ('PC_2', 2, 1, 'SW_2')):
+            with self.assertRaises(ValueError):
+                registry.add_pc(name, Station(mac, switch, port), sw_name)
+        with self.assertRaises(ValueError):
+            registry.add_switch('PC_1', Switch(4))
+        self.assertEqual((list(registry.pcs), registry.pc_by_mac(1), registry.pc_by_mac(2)), (['PC_1'], 'PC_1', None))
+        self.assertEqual(registry.switch_pcs('SW_1'), ['PC_1'])
+        # The same checks in the shell and in topology files; a topology with an error adds nothing
+        env = RuntimeEnv()
+        output = run_script(env, ['create switch SW_1 4', 'create switch SW_2 4',
+                                  'create pc PC_1 SW_1 0000.0000.0001 0',
+                                  'create pc PC_2 SW_1 0000.0000.0001 1', 'create pc PC_2 SW_1 0000.0000.0002 0',
+                                  'create pc SW_2 SW_1 0000.0000.0003 1', 'create trunk SW_1 3 SW_2 3 1',
+                                  'create pc PC_4 SW_1 0000.0000.0004 3'])
+        self.assertEqual(output.count("Invalid input"), 4)
+        self.assertEqual(list(env.network_objects['pc']), ['PC_1'])
+        topology = {'switches': [{'name': 'SW_1', 'ports': 8}, {'name': 'SW_2', 'ports': 8}],
+                    'pcs': [{'name': 'PC_1', 'switch': 'SW_1', 'mac': '0000.0000.0001', 'port': 0}]}
+        bad = [({'switches': topology['switches'] + [{'name': 'SW_1', 'ports': 4}]},
+                'switches[2]: Name SW_1 is already used'),
+               ({'pcs': topology['pcs'] + [{'name': 'PC_2', 'switch': 'SW_2', 'mac': '0000.0000.0001', 'port': 0}]},
+                'pcs[1]: MAC address 0000.0000.0001 is used by PC_1'),
+               ({'pcs': topology['pcs'] + [{'name': 'PC_2', 'switch': 'SW_1', 'mac': '0000.0000.0002', 'port': 0}]},
+                "pcs[1]: Switch SW_1 doesn't have port 0 or the port is used")]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'topology.json')
+            for changes, message in bad:
+                env = RuntimeEnv()
+                with open(path, 'w') as topology_file:
+                    json.dump(dict(topology, **changes), topology_file)
+                with self.assertRaises(ValueError) as error:
+                    env.load_topology(path)
+                self.assertEqual(str(error.exception), message)
+                self.assertEqual((env.network_objects['switch'], env.network_objects['pc']), ({}, {}))
+
+    def test_show_network(self):
+        env = RuntimeEnv()
+        output = run_script(env, ['create switch SW_1 4', 'create switch SW_2 4',
+                                  'create pc PC_1 SW_1 0000.0000.0001 0',
+                                  'create pc PC_3 SW_2 0000.0000.0003 1', 'create pc PC_2 SW_1 0000.0000.0002 2',
+                                  'create trunk SW_1 3 SW_2 3 1', 'show network'])
+        self.assertEqual(output, "Switches:\n"
+                                 "Switch name:SW_1, number of ports:4, used:{0, 2, 3}\n"
+                                 "PCs connected: PC_1 PC_2 \n"
+                                 "Switch name:SW_2, number of ports:4, used:{1, 3}\n"
+                                 "PCs connected: PC_3 \n")
+
+    def test_fabric_delivers_to_stations(self):
+        fabric = Fabric()
+        switch = Switch(4)
+        first, second = Station(1, switch, 0), Station(2, switch, 1)
+        fabric.attach(first)
+        fabric.attach(second)
+        fabric.send(first, second.mac)
+        fabric.run()
+        self.assertEqual(second.total_received, 1)
+        self.assertEqual(format_mac(second.mac), '0000.0000.0002')
+
+
+
+class FabricTest(unittest.TestCase):
+
+    def test_trunks_and_vlans(self):
+        fabric = Fabric()
+        first, middle, last = Switch(8), Switch(8), Switch(8)
+        for switch in (first, last):
+            switch.create_vlan(2)
+            switch.assign_ports_to_vlan(2, [2, 3])
+        self.assertTrue(fabric.connect(first, 7, middle, 7))
+        self.assertTrue(fabric.connect(middle, 6, last, 7, 2))
+        # The third link would close a loop of the switches
+        self.assertFalse(fabric.connect(last, 6, first, 6))
+        self.assertEqual(first.trunk_ports, {7: True, 6: False})
+        with self.assertRaises(ValueError):
+            fabric.connect(first, 6, middle, 5)
+        stations = {name: Station(mac, switch, port) for name, (mac, switch, port) in
+                    {'A1': (1, first, 0), 'A2': (2, first, 2), 'B1': (3, middle, 0), 'C1': (4, last, 0),
+                     'C2': (5, last, 3)}.items()}
+        for station in stations.values():
+            fabric.attach(station)
+
+        def received():
+            return {name: station.total_received for name, station in stations.items()}
+
+        # A broadcast of VLAN 2 crosses the middle switch tagged and reaches only VLAN 2 of the last switch
+        fabric.send(stations['A2'], BROADCAST_MAC)
+        self.assertEqual(fabric.run(), 3)
+        self.assertEqual(fabric.now, 3)
+        self.assertEqual(received(), {'A1': 0, 'A2': 0, 'B1': 0, 'C1': 0, 'C2': 1})
+        fabric.send(stations['C2'], 2)
+        fabric.send(stations['A1'], 4)
+        fabric.run()
+        self.assertEqual(received(), {'A1': 0, 'A2': 1, 'B1': 0, 'C1': 1, 'C2': 1})
+        self.assertEqual(middle.get_sent_for_port(0), 1)
+        # Nothing goes over the blocked link
+        self.assertEqual((first.get_sent_for_port(6), last.get_sent_for_port(6)), (0, 0))
+        self.assertEqual((first.get_received_for_port(6), last.get_received_for_port(6)), (0, 0))
+
+    def test_trunk_port_of_station(self):
+        fabric = Fabric()
+        first, second = Switch(4), Switch(4)
+        fabric.connect(first, 3, second, 3)
+        with self.assertRaises(ValueError):
+            fabric.attach(Station(1, first, 3))
+        fabric.attach(Station(2, first, 0))
+        with self.assertRaises(ValueError):
+            fabric.connect(first, 0, second, 0)
+
+
+
+class StationEngineTest(unittest.TestCase):
+
+    # Every workstation of a switch sends frames to the others; returns the statistics, frames received
+    # by every workstation and frames dropped at every port
+
+    def run_engine(self, queue_size, backpressure, seed=0):
+        fabric = Fabric()
+        switch = Switch(32)
+        stations = [Station(mac, switch, mac - 1) for mac in range(1, 21)]
+        for station in stations:
+            fabric.attach(station)
+        engine = StationEngine(fabric, queue_size, backpressure, seed)
+        stats = engine.run(stations, 30)
+        return (stats, [station.total_received for station in stations],
+                sorted((port, frames) for (_, port), frames in engine.drops.items()))
+
+    def test_backpressure(self):
+        stats, received, drops = self.run_engine(1, True)
+        self.assertEqual((stats['sent'], stats['delivered'], stats['dropped']), (600, 600, 0))
+        self.assertEqual(stats['max_queue_depth'], 1)
+        self.assertEqual(sum(received), 600)
+        self.assertEqual(drops, [])
+        self.assertLessEqual(self.run_engine(4, True)[0]['max_queue_depth'], 4)
+
+    def test_tail_drop(self):
+        stats, received, drops = self.run_engine(1, False)
+        self.assertGreater(stats['dropped'], 0)
+        self.assertEqual(stats['delivered'] + stats['dropped'], stats['sent'])
+        self.assertEqual(sum(received), stats['delivered'])
+        self.assertEqual(sum(frames for _, frames in drops), stats['dropped'])
+        self.assertEqual(stats['max_queue_depth'], 1)
+
+    def test_same_seed_same_results(self):
+        for backpressure in (True, False):
+            self.assertEqual(self.run_engine(1, backpressure, 5), self.run_engine(1, backpressure, 5))
+        self.assertNotEqual(self.run_engine(1, False, 5)[1], self.run_engine(1, False, 6)[1])
+        with self.assertRaises(ValueError):
+            StationEngine(Fabric(), 0)
+
+
+
+class StatsStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_changed_ports(self):
+        for seed in range(30):
+            rnd = random.Random(seed)
+            switch = make_switch()
+            switch._take_changed_ports()
+            for _ in range(10):
+                before = switch_state(switch)[:2]
+                frames = random_frames(rnd, 16, rnd.randint(0, 30))
+                if frames and rnd.random() < 0.5:
+                    switch.send_frames(*zip(*frames))
+                else:
+                    for frame in frames:
+                        switch.send_frame(*frame)
+                after = switch_state(switch)[:2]
+                changed = {port for port in range(16) if before[0][port] != after[0][port]
+                           or before[1][port] != after[1][port]}
+                self.assertEqual(switch._take_changed_ports(), changed, seed)
+            self.assertEqual(switch._take_changed_ports(), set())
+
+    def test_samples(self):
+        rows = {}
+        for name in ('stats.csv', 'stats.jsonl'):
+            switch = Switch(8)
+            switch.send_frame(1, 2, 0)
+            switches = {'SW': [switch, set()]}
+            stream = StatsStream(self.path(name), 0, 3)
+            stream.begin(switches)
+            switch.send_frame(2, 1, 3)
+            switch.send_frame(1, 2, 0)
+            stream.sample(switches)
+            stream.sample(switches)
+            stream.poll(switches)
+            switch.send_frame(2, 1, 3)
+            stream.close(switches)
+            self.assertEqual((stream.samples, stream.rows_written), (4, 4))
+            with open(self.path(name)) as stats:
+                if name.endswith('.jsonl'):
+                    rows[name] = [json.loads(line) for line in stats]
+                else:
+                    rows[name] = [dict(zip(StatsStream.FIELDS, row)) for row in list(csv.reader(stats))[1:]]
+            rows[name] = [[row[field] for field in StatsStream.FIELDS[1:]] for row in rows[name]]
+        # The first row of a port counts from zero, then the rows only have ports which changed
+        self.assertEqual(rows['stats.jsonl'], [[1, 'SW', 0, 1, 2, 1, 2], [1, 'SW', 3, 2, 1, 2, 1],
+                                               [4, 'SW', 0, 2, 2, 1, 0], [4, 'SW', 3, 2, 2, 0, 1]])
+        self.assertEqual(rows['stats.csv'], [[str(value) for value in row] for row in rows['stats.jsonl']])
+
+    def test_restored_switches_are_not_loaded(self):
+        env = RuntimeEnv()
+        run_script(env, ['create switch SW_1 4', 'create pc PC_1 SW_1 0000.0000.0001 0', 'send PC_1 PC_1 2'])
+        env.save(self.path('full.snap'))
+        env.load(self.path('full.snap'))
+        switches = env.network_objects['switch']
+        stream = StatsStream(self.path('stats.csv'), 0)
+        stream.begin(switches)
+        stream.close(switches)
+        self.assertEqual(stream.rows_written, 0)
+        self.assertIn('_record', switches['SW_1'][0].__dict__)
+
+
+if __name__ == '__main__':
+    unittest.main()